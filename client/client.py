@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import gzip
 import logging
 import math
 import os
 import os.path
 import re
-import signal
 import subprocess
 import sys
+import threading
 import time
 import random
 from datetime import datetime
-from multiprocessing import Pool
-from threading import Timer
+from queue import Queue, Empty
 
 import requests
 import json
@@ -83,44 +84,224 @@ def parse_args():
                         metavar='THREADS',
                         required=False,
                         default=64,
-                        help='Maximum number of threads to spawn')
+                        help='Maximum number of exploits running at the same time')
+
+    parser.add_argument('--spool',
+                        type=str,
+                        metavar='FILE',
+                        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'flags_spool.ndjson'),
+                        help='Where flags are kept while the server is unreachable')
 
     return parser.parse_args()
 
 
-def run_exploit(exploit: str, ip: str, round_duration: int, server_url: str, token: str, pattern, user: str):
-    def timer_out(process):
-        timer.cancel()
-        process.kill()
+# Longest output line of an exploit (longer ones are skipped)
+LINE_LIMIT = 1024 * 1024
+UPLOAD_INTERVAL = 0.3  # seconds flags are collected before being sent together
+UPLOAD_MAX_FLAGS = 1000  # flags per upload
+UPLOAD_TIMEOUT = 10  # seconds
+SPOOL_RETRY = 5  # seconds between two attempts to send the spooled flags
+SPOOL_CHUNK = 10000  # spooled flags per request when they are sent again
+
+
+class FlagUploader:
+    """Sends the flags found by all the exploits to the server from a background thread.
+
+    Flags are collected for UPLOAD_INTERVAL seconds and sent in one request, on a kept-alive connection.
+    When the server can't be reached they are appended to the spool file, which is sent again (to
+    /api/upload_flags_stream) every SPOOL_RETRY seconds until the server gets them: it drops duplicates.
+    Errors never stop the thread: the flags it couldn't send are spooled.
+    """
+
+    def __init__(self, server_url: str, token: str, user: str, spool: str):
+        self.server_url = server_url
+        self.user = user
+        self.spool = spool
+        self.session = requests.Session()
+        self.session.headers['X-Auth-Token'] = token
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='uploader')
+
+    def start(self):
+        self._thread.start()
+
+    def add(self, flags):
+        self._queue.put(flags)
+
+    def close(self):
+        """Send (or spool) the flags still waiting, then stop."""
+        self._queue.put(None)
+        self._thread.join(UPLOAD_TIMEOUT + 1)
+
+    def _run(self):
+        self._replay()
+        while True:
+            try:
+                flags = self._queue.get(timeout=SPOOL_RETRY if os.path.exists(self.spool) else None)
+            except Empty:
+                self._replay()
+                continue
+            if flags is None:
+                return
+            batch = list(flags)
+            deadline = time.monotonic() + UPLOAD_INTERVAL
+            closing = False
+            while len(batch) < UPLOAD_MAX_FLAGS:
+                try:
+                    flags = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if flags is None:
+                    closing = True
+                    break
+                batch.extend(flags)
+            # Whatever happens, the uploader keeps going and the flags end up in the spool
+            try:
+                if self._send(batch):
+                    self._replay()
+            except Exception as e:
+                logging.exception(f'Unexpected error while uploading {len(batch)} flags')
+                self._spool(batch, e.__class__.__name__)
+            if closing:
+                return
+
+    @staticmethod
+    def _new_count(r):
+        """Number of new flags of an upload response, None if it doesn't look like it comes from the server."""
+        try:
+            return int(r.json()['new'])
+        except (ValueError, KeyError, TypeError):
+            return None
 
-    p = subprocess.Popen(
-        [exploit, ip], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    timer = Timer(math.ceil(0.5 * round_duration), timer_out, args=[p])
+    def _send(self, batch) -> bool:
+        """Upload the batch, or spool it if the server can't take it right now. Returns True if it was uploaded."""
+        try:
+            r = self.session.post(self.server_url + '/api/upload_flags',
+                                  json={'username': self.user, 'flags': batch},
+                                  timeout=UPLOAD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            self._spool(batch, e.__class__.__name__)
+            return False
+        if r.status_code >= 500:
+            self._spool(batch, f'[{r.status_code}]')
+            return False
+        if r.status_code != 200:
+            logging.error(f'POST {self.server_url}/api/upload_flags responded with [{r.status_code}]: '
+                          f'{len(batch)} flags dropped')
+            return False
+        new = self._new_count(r)
+        if new is None:
+            # e.g. the error page of a proxy
+            self._spool(batch, f'[{r.status_code}] unexpected response')
+            return False
+        logging.info(f'Uploaded {GREEN}{len(batch)}{END} flags ({GREEN}{new}{END} new)')
+        return True
 
-    timer.start()
+    def _spool(self, batch, reason: str):
+        try:
+            with open(self.spool, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps({'username': self.user, **flag}) + '\n' for flag in batch)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logging.error(f'Could not upload {RED}{len(batch)}{END} flags ({reason}) nor save them in '
+                          f'{self.spool} ({e}): they are lost')
+            return
+        logging.warning(f'Could not upload {YELLOW}{len(batch)}{END} flags ({reason}): '
+                        f'saved in {self.spool}, retrying in {SPOOL_RETRY} seconds')
+
+    def _replay(self):
+        """Send the spooled flags again, SPOOL_CHUNK at a time.
+
+        The chunks the server rejects are appended to the .rejected file next to the spool, the ones that
+        can't be sent yet stay in the spool for the next attempt.
+        """
+        if not os.path.exists(self.spool):
+            return
+        try:
+            with open(self.spool, 'rb') as f:
+                records = f.readlines()
+            done = 0
+            while done < len(records):
+                chunk = records[done:done + SPOOL_CHUNK]
+                try:
+                    r = self.session.post(self.server_url + '/api/upload_flags_stream',
+                                          params={'username': self.user},
+                                          data=gzip.compress(b''.join(chunk)),
+                                          headers={'Content-Type': 'application/x-ndjson',
+                                                   'Content-Encoding': 'gzip'},
+                                          timeout=UPLOAD_TIMEOUT)
+                except requests.exceptions.RequestException:
+                    break
+                if r.status_code >= 500:
+                    break
+                if r.status_code == 200:
+                    new = self._new_count(r)
+                    if new is None:
+                        break
+                    logging.info(f'Uploaded {GREEN}{len(chunk)}{END} spooled flags ({GREEN}{new}{END} new)')
+                else:
+                    with open(self.spool + '.rejected', 'ab') as f:
+                        f.writelines(chunk)
+                    logging.error(f'POST {self.server_url}/api/upload_flags_stream responded with '
+                                  f'[{r.status_code}]: {len(chunk)} spooled flags moved to {self.spool}.rejected')
+                done += len(chunk)
+            if done == len(records):
+                os.remove(self.spool)
+            elif done:
+                with open(self.spool + '.tmp', 'wb') as f:
+                    f.writelines(records[done:])
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.spool + '.tmp', self.spool)
+        except Exception:
+            logging.exception(f'Unexpected error while sending {self.spool} again')
+
+
+async def read_output(p, exploit: str, ip: str, pattern, uploader: FlagUploader):
+    """Upload the flags printed by the exploit, until it exits."""
     while True:
-        output = p.stdout.readline().decode().strip()
-        if output == '' and p.poll() is not None:
+        try:
+            line = await p.stdout.readline()
+        except ValueError:
+            logging.warning(f'{os.path.basename(exploit)}@{ip} printed a line longer than {LINE_LIMIT} bytes, skipped')
+            continue
+        if not line:
             break
+        output = line.decode(errors='replace').strip()
         if output:
             logging.debug(f'{os.path.basename(exploit)}@{ip} => {output}')
             flags = set(pattern.findall(output))
             if flags:
                 exp = exploit.split('/')[-1][:-3]
-                logging.info(f'Got {GREEN}{len(flags)}{END} flags with {BLUE}{exp}{END} from {ip}')
-                msg = {'username': user, 'flags': []}
                 t_stamp = datetime.now().replace(microsecond=0).isoformat(sep=' ')
-                for flag in flags:
-                    msg['flags'].append({'flag': flag,
-                                         'exploit_name': os.path.basename(exploit),
-                                         'team_ip': ip,
-                                         'time': t_stamp})
-                requests.post(server_url + '/api/upload_flags',
-                              headers={'X-Auth-Token': token},
-                              json=msg)
-    p.stdout.close()
-    return_code = p.poll()
-    timer.cancel()
+                uploader.add([{'flag': flag,
+                               'exploit_name': os.path.basename(exploit),
+                               'team_ip': ip,
+                               'time': t_stamp} for flag in flags])
+                logging.info(f'Got {GREEN}{len(flags)}{END} flags with {BLUE}{exp}{END} from {ip}')
+    await p.wait()
+
+
+async def run_exploit(exploit: str, ip: str, round_duration: int, pattern, uploader: FlagUploader,
+                      slots: asyncio.Semaphore):
+    async with slots:
+        try:
+            p = await asyncio.create_subprocess_exec(exploit, ip, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                     limit=LINE_LIMIT)
+        except OSError as e:
+            logging.error(f'{RED}{os.path.basename(exploit)}{END}@{ip} could not be started: {e}')
+            return
+        try:
+            await asyncio.wait_for(read_output(p, exploit, ip, pattern, uploader),
+                                   timeout=math.ceil(0.5 * round_duration))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # Timed out, or interrupted: don't leave it running
+            if p.returncode is None:
+                p.kill()
+        return_code = await p.wait()
     if return_code == -9:
         logging.error(
             f'{RED}{os.path.basename(exploit)}{END}@{ip} was killed because it took too long to finish')
@@ -129,6 +310,13 @@ def run_exploit(exploit: str, ip: str, round_duration: int, server_url: str, tok
             f'{RED}{os.path.basename(exploit)}{END}@{ip} terminated with error code {HIGH_RED}{return_code}{END}')
 
 
+async def run_round(scripts, teams, num_threads: int, round_duration: int, pattern, uploader: FlagUploader):
+    """Run every exploit against every team, at most num_threads at a time, all in this process."""
+    slots = asyncio.Semaphore(num_threads)
+    await asyncio.gather(*(run_exploit(script, team, round_duration, pattern, uploader, slots)
+                           for script in scripts for team in teams))
+
+
 def download_flag_ids_ccit(flagid_url, nopTeam, team_token) -> bool:
     """
     Returns True if successful
@@ -212,7 +400,6 @@ download_flag_ids = download_flag_ids_hitb
 
 
 def main(args):
-    global pool
     print(BANNER)
 
     # Parse parameters
@@ -222,6 +409,7 @@ def main(args):
     verbose = args.verbose
     exploit_directory = args.exploit_directory
     num_threads = args.num_threads
+    spool = args.spool
 
     logging.basicConfig(format='%(asctime)s %(levelname)s - %(message)s',
                         datefmt='%H:%M:%S', level=logging.DEBUG if verbose else logging.INFO)
@@ -261,10 +449,13 @@ def main(args):
     team_token = config['team_token']
     logging.info('Client correctly configured.')
 
+    # Flags are spooled while the server is unreachable: the exploits keep running in the meantime
+    uploader = FlagUploader(server_url, token, user, spool)
+    uploader.start()
+
     # MAIN LOOP
     while True:
         try:
-            requests.head(server_url)
             s_time = time.time()
 
             # Retrieve flag_ids
@@ -314,19 +505,10 @@ def main(args):
                 time.sleep(15)
                 continue
 
-            original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-            pool = Pool(min(num_threads, len(scripts) * len(teams)))
-            signal.signal(signal.SIGINT, original_sigint_handler)
-
             # Run exploits
             random.shuffle(scripts)
             random.shuffle(teams)
-            for script in scripts:
-                for team in teams:
-                    pool.apply_async(
-                        run_exploit, (script, team, round_duration, server_url, token, flag_format, user))
-            pool.close()
-            pool.join()
+            asyncio.run(run_round(scripts, teams, num_threads, round_duration, flag_format, uploader))
 
             duration = time.time() - s_time
             logging.debug(f'round took {round(duration, 1)} seconds')
@@ -338,7 +520,7 @@ def main(args):
         # Exceptions
         except KeyboardInterrupt:
             logging.info('Caught KeyboardInterrupt. Bye!')
-            pool.terminate()
+            uploader.close()
             break
         except requests.exceptions.RequestException:
             logging.error(
@@ -2,13 +2,12 @@ import logging
 import os
 import threading
 
-import werkzeug
 from flask import Flask
 
 from . import submission_loop
 
 
-def create_app():
+def create_app(test_config=None):
     app = Flask('flagWarehouse', instance_relative_config=False)
 
     log = logging.getLogger('werkzeug')
@@ -16,6 +15,8 @@ def create_app():
     log.disabled = True
 
     app.config.from_object('config.Config')
+    if test_config is not None:
+        app.config.update(test_config)
 
     try:
         os.makedirs(app.instance_path)
@@ -25,6 +26,32 @@ def create_app():
     from . import db
     db.init_app(app)
 
+    from . import storage
+    storage.init_app(app)
+
+    from . import ingest
+    ingest.init_app(app)
+
+    from . import flag_queue
+    flag_queue.init_app(app)
+
+    submission_loop.init_app(app)
+
+    from . import archive
+    archive.init_app(app)
+
+    from . import maintenance
+    maintenance.init_app(app)
+
+    from . import cache
+    cache.init_app(app)
+
+    from . import stream
+    stream.init_app(app)
+
+    from . import compress
+    compress.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -38,10 +65,15 @@ def create_app():
     from . import submit
     app.register_blueprint(submit.bp)
 
-    if not werkzeug.serving.is_running_from_reloader():
-        threading.Thread(target=submission_loop.loop,
-                         daemon=True,
-                         name='submission_loop',
-                         kwargs={'app': app}).start()
+    # With SUBMITTER = 'process' the loop runs in its own process instead (`flask submitter`).
+    # The queue of the loop is fed by the uploads of its own process, so it starts with the first request:
+    # in the process that serves them (not in the parent process of the reloader), and never in CLI commands
+    if app.config['SUBMITTER'] == 'thread':
+        @app.before_first_request
+        def start_submission_loop():
+            threading.Thread(target=submission_loop.loop,
+                             daemon=True,
+                             name='submission_loop',
+                             kwargs={'app': app}).start()
 
     return app
@@ -1,8 +1,20 @@
+import json
+import zlib
+from concurrent import futures
+
 from flask import current_app, Blueprint, request, jsonify
-import sqlite3
-import time
 
-from . import db
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import cache, db, ingest, stream, submission_loop
 from .auth import api_auth_required
 
 bp = Blueprint('api', __name__)
@@ -22,28 +34,138 @@ def get_config():
     return jsonify(config_dict)
 
 
+@bp.route('/api/stats', methods=['GET'])
+@api_auth_required
+def stats():
+    return jsonify({
+        'db_pool': db.get_pool().stats(),
+        'chart_cache': cache.get_chart_cache().stats(),
+        'chart_stream': {'viewers': len(stream.get_stream())},
+        **submission_loop.loop_stats(),
+    })
+
+
 @bp.route('/api/upload_flags', methods=['POST'])
 @api_auth_required
 def upload_flags():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('flags'), list):
+        return 'Expected a JSON object with a "flags" list', 400
     username = data.get('username')
     # current_app.logger.debug(f"{len(data.get('flags'))} flags received from user {username}")
     rows = []
-    for item in data.get('flags'):
+    for i, item in enumerate(data['flags']):
+        if not isinstance(item, dict):
+            return f'Flag {i + 1} is not an object', 400
         rows.append((item.get('flag'), username, item.get('exploit_name'), item.get('team_ip'), item.get('time'),
                      current_app.config['DB_NSUB']))
 
-    # Try multiple times before failing
-    for i in range(5):
-        try:
-            database = db.get_db()
-            database.executemany('INSERT OR IGNORE INTO flags (flag, username, exploit_name, team_ip, time, status) '
-                                'VALUES (?, ?, ?, ?, ?, ?)', rows)
-            database.commit()
+    # Rows are committed by the ingest writer together with everybody else's uploads
+    try:
+        new = ingest.store_flags(rows)
+    except ValueError as e:
+        return str(e), 400
+    except futures.TimeoutError:
+        return 'Database busy, try again later', 503
+
+    return jsonify({'new': new, 'duplicate': len(rows) - new})
+
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class BadRecord(ValueError):
+    pass
+
+
+def _decompressor(encoding: str):
+    if encoding in ('', 'identity'):
+        return None
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise BadRecord(f'Unsupported Content-Encoding {encoding}')
+
+
+def _body_chunks(chunk_size=64 * 1024):
+    decompressor = _decompressor(request.headers.get('Content-Encoding', '').strip().lower())
+    while True:
+        chunk = request.stream.read(chunk_size)
+        if not chunk:
             break
-        except sqlite3.OperationalError:
-            if i == 4:
-                raise
-            time.sleep(0.2)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+
+
+def _ndjson_records(chunks):
+    buffer = b''
+    line_number = 0
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    raise BadRecord(f'Invalid JSON on line {line_number}')
+    if buffer.strip():
+        try:
+            yield json.loads(buffer)
+        except ValueError:
+            raise BadRecord(f'Invalid JSON on line {line_number + 1}')
+
+
+def _msgpack_records(chunks):
+    unpacker = msgpack.Unpacker(raw=False)
+    for chunk in chunks:
+        unpacker.feed(chunk)
+        try:
+            yield from unpacker
+        except ValueError as e:
+            raise BadRecord(f'Invalid msgpack data: {e}')
+
+
+@bp.route('/api/upload_flags_stream', methods=['POST'])
+@api_auth_required
+def upload_flags_stream():
+    """Bulk upload: one flag object per record, as NDJSON or msgpack, optionally gzip/zstd compressed.
+
+    Records look like the items of upload_flags' "flags" list; the username comes from the "username"
+    query parameter, unless a record has its own. Rows are stored in batches while the body is read.
+    """
+    content_type = request.mimetype
+    if content_type in NDJSON_TYPES:
+        parse = _ndjson_records
+    elif content_type in MSGPACK_TYPES and msgpack is not None:
+        parse = _msgpack_records
+    else:
+        return f'Unsupported Content-Type {content_type}', 415
+
+    username = request.args.get('username')
+    batch_size = current_app.config['INGEST_MAX_ROWS']
+    received = 0
+    new = 0
+    rows = []
+    try:
+        for item in parse(_body_chunks()):
+            if not isinstance(item, dict):
+                raise BadRecord(f'Record {received + 1} is not an object')
+            rows.append((item.get('flag'), item.get('username', username), item.get('exploit_name'),
+                         item.get('team_ip'), item.get('time'), current_app.config['DB_NSUB']))
+            received += 1
+            if len(rows) >= batch_size:
+                new += ingest.store_flags(rows)
+                rows = []
+        new += ingest.store_flags(rows)
+    except (ValueError, zlib.error) as e:  # including BadRecord
+        return jsonify({'error': str(e), 'new': new, 'duplicate': received - len(rows) - new}), 400
+    except futures.TimeoutError:
+        return 'Database busy, try again later', 503
 
-    return 'Data received', 200
+    return jsonify({'new': new, 'duplicate': received - new})
@@ -0,0 +1,46 @@
+import time
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+from . import storage
+from .storage import archive_time
+
+
+def archive_all(flags) -> int:
+    """Archive every flag old enough, ARCHIVE_BATCH at a time (short transactions don't hold back the uploads)."""
+    until = archive_time()
+    batch = current_app.config['ARCHIVE_BATCH']
+    archived = 0
+    while True:
+        moved = flags.archive(until, batch)
+        archived += moved
+        if moved < batch:
+            return archived
+
+
+def run(app: Flask, stats):
+    """Archive old flags every ARCHIVE_INTERVAL seconds until the process exits.
+
+    Started by the submission loop, so that it runs in a single process, where flags get their final response.
+    """
+    with app.app_context():
+        flags = storage.get_storage()
+        while True:
+            time.sleep(current_app.config['ARCHIVE_INTERVAL'])
+            try:
+                stats['archived'] += archive_all(flags)
+            except flags.ERRORS as e:
+                current_app.logger.warning(f'archive: {e}')
+
+
+@click.command('archive-flags')
+@with_appcontext
+def archive_flags_command():
+    """Move the old flags with a final response to the archive now."""
+    click.echo(f'Archived {archive_all(storage.get_storage())} flags.')
+
+
+def init_app(app):
+    app.cli.add_command(archive_flags_command)
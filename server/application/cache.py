@@ -0,0 +1,77 @@
+import hashlib
+import threading
+import time
+
+from flask import current_app
+
+
+class ResponseCache:
+    """Short-lived cache of response bodies, shared by all the clients, with an ETag for each of them.
+
+    Only one request computes a missing or stale entry (single flight): the others asking for the same key
+    wait for its result instead of running the same queries.
+    """
+
+    MAX_ENTRIES = 256
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}  # key -> (expiry, etag, body)
+        self._computing = {}  # key -> Event set when the entry has been computed
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+
+    def get(self, key, compute):
+        """Returns (etag, body) for key, calling compute() -> bytes if there is no fresh entry."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._hits += 1
+                    return entry[1], entry[2]
+                computing = self._computing.get(key)
+                if computing is None:
+                    computing = self._computing[key] = threading.Event()
+                    self._misses += 1
+                    break
+            computing.wait()
+
+        try:
+            body = compute()
+            etag = hashlib.md5(body).hexdigest()
+            with self._lock:
+                if len(self._entries) >= self.MAX_ENTRIES:
+                    now = time.monotonic()
+                    self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                self._entries[key] = (time.monotonic() + self.ttl, etag, body)
+            return etag, body
+        finally:
+            with self._lock:
+                del self._computing[key]
+            computing.set()
+
+    def not_modified(self):
+        """Count a response answered with 304 Not Modified."""
+        with self._lock:
+            self._not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / requests, 3) if requests else None,
+                'not_modified': self._not_modified,
+            }
+
+
+def get_chart_cache() -> ResponseCache:
+    return current_app.extensions['chart_cache']
+
+
+def init_app(app):
+    app.extensions['chart_cache'] = ResponseCache(app.config['CHART_CACHE_TTL'])
@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson', 'image/svg+xml',
+}
+# Precompressed variants of static files, in order of preference
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+FINGERPRINTED_MAX_AGE = 365 * 24 * 3600
+
+
+class CompressedBodies:
+    """Last compressed response bodies, by hash of their content: the same page isn't compressed again."""
+
+    def __init__(self, size=64):
+        self.size = size
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        key = hashlib.md5(data).digest()
+        with self._lock:
+            if key in self._bodies:
+                self._bodies.move_to_end(key)
+                return self._bodies[key]
+        compressed = gzip.compress(data, level)
+        with self._lock:
+            self._bodies[key] = compressed
+            if len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+        return compressed
+
+
+def gzip_stream(chunks, level: int):
+    compressor = zlib.compressobj(level, wbits=31)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# Slower on localhost, might save your life in any other setting.
+# Don't waste your bandwidth, kids.
+def compress_response(response):
+    """gzip the response if the client accepts it. Streamed responses are compressed while they are sent."""
+    if (response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return response
+
+    level = current_app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        response.response = gzip_stream(response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(current_app.extensions['compressed_bodies'].compress(data, level))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def is_up_to_date(path, extension):
+    """Whether path has a compressed variant (path + extension) newer than itself."""
+    try:
+        return os.path.getmtime(path + extension) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def send_static_file(filename):
+    """Replaces Flask's static view: serves the precompressed variant of the file if there is one
+    (see `flask compress-static`), and lets fingerprinted URLs be cached forever."""
+    static_folder = current_app.static_folder
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, extension in STATIC_ENCODINGS:
+        if encoding in request.accept_encodings and is_up_to_date(os.path.join(static_folder, filename), extension):
+            response = send_from_directory(static_folder, filename + extension, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(static_folder, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if request.args.get('v'):
+        response.cache_control.public = True
+        response.cache_control.max_age = FINGERPRINTED_MAX_AGE
+        response.cache_control.immutable = True
+        response.expires = None
+    return response
+
+
+def fingerprint(app, filename):
+    """Hash of the content of a static file, recomputed when the file changes."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    fingerprints = app.extensions['static_fingerprints']
+    if filename not in fingerprints or fingerprints[filename][0] != mtime:
+        with open(path, 'rb') as f:
+            fingerprints[filename] = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+    return fingerprints[filename][1]
+
+
+def add_fingerprint(endpoint, values):
+    # url_for('static', filename=...) -> /static/...?v=<fingerprint>
+    if endpoint == 'static' and 'v' not in values:
+        v = fingerprint(current_app, values.get('filename', ''))
+        if v:
+            values['v'] = v
+
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static_command():
+    """Write .gz (and .br, if brotli is installed) next to the compressible static files."""
+    written = 0
+    for root, _, files in os.walk(current_app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if (name.endswith(tuple(extension for _, extension in STATIC_ENCODINGS))
+                    or mimetypes.guess_type(name)[0] not in COMPRESSIBLE_TYPES
+                    or os.path.getsize(path) < current_app.config['COMPRESS_MIN_SIZE']):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for extension, compress in (('.gz', lambda d: gzip.compress(d, 9)),
+                                        ('.br', brotli.compress if brotli else None)):
+                if compress is None:
+                    continue
+                if is_up_to_date(path, extension):
+                    continue
+                with open(path + extension, 'wb') as f:
+                    f.write(compress(data))
+                written += 1
+    click.echo(f'Compressed {written} static files.')
+
+
+def init_app(app):
+    app.extensions['compressed_bodies'] = CompressedBodies()
+    app.extensions['static_fingerprints'] = {}
+    app.after_request(compress_response)
+    app.url_defaults(add_fingerprint)
+    app.view_functions['static'] = send_static_file
+    app.cli.add_command(compress_static_command)
@@ -1,44 +1,356 @@
 import sqlite3
+import threading
+from datetime import datetime
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+# Applied once, when a connection is opened (with PRAGMA synchronous=DB_SYNCHRONOUS)
+PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',  # KiB
+    'PRAGMA mmap_size=268435456',
+)
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA journal_mode=WAL")
 
-    return g.db
+# Applied in order by migrate() to databases created by an older schema.sql (their version is in user_version).
+# schema.sql always creates the latest version. Functions are called to get the script.
+MIGRATIONS = (
+    # 1: index for the submission queue and the expiry sweep
+    'CREATE INDEX IF NOT EXISTS idx_pending ON flags (status, server_response, time);',
+    # 2: dashboard counters, filled with the existing flags (the triggers are the same as in schema.sql)
+    '''
+    CREATE TABLE IF NOT EXISTS flags_rollup
+    (
+        minute       TEXT    NOT NULL,
+        exploit_name TEXT    NOT NULL,
+        team_ip      TEXT    NOT NULL,
+        status       TEXT    NOT NULL,
+        count        INTEGER NOT NULL,
+        PRIMARY KEY (minute, exploit_name, team_ip, status)
+    ) WITHOUT ROWID;
+    INSERT INTO flags_rollup (minute, exploit_name, team_ip, status, count)
+    SELECT substr(time, 1, 16), exploit_name, team_ip, COALESCE(server_response, status), COUNT(*)
+    FROM flags
+    GROUP BY 1, 2, 3, 4;
+    CREATE TRIGGER IF NOT EXISTS flags_rollup_insert AFTER INSERT ON flags
+    BEGIN
+        INSERT INTO flags_rollup (minute, exploit_name, team_ip, status, count)
+        VALUES (substr(NEW.time, 1, 16), NEW.exploit_name, NEW.team_ip, COALESCE(NEW.server_response, NEW.status), 1)
+        ON CONFLICT (minute, exploit_name, team_ip, status) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flags_rollup_update AFTER UPDATE OF status, server_response ON flags
+        WHEN COALESCE(OLD.server_response, OLD.status) IS NOT COALESCE(NEW.server_response, NEW.status)
+    BEGIN
+        UPDATE flags_rollup SET count = count - 1
+        WHERE minute = substr(OLD.time, 1, 16) AND exploit_name = OLD.exploit_name AND team_ip = OLD.team_ip
+          AND status = COALESCE(OLD.server_response, OLD.status);
+        INSERT INTO flags_rollup (minute, exploit_name, team_ip, status, count)
+        VALUES (substr(NEW.time, 1, 16), NEW.exploit_name, NEW.team_ip, COALESCE(NEW.server_response, NEW.status), 1)
+        ON CONFLICT (minute, exploit_name, team_ip, status) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flags_rollup_delete AFTER DELETE ON flags
+    BEGIN
+        UPDATE flags_rollup SET count = count - 1
+        WHERE minute = substr(OLD.time, 1, 16) AND exploit_name = OLD.exploit_name AND team_ip = OLD.team_ip
+          AND status = COALESCE(OLD.server_response, OLD.status);
+    END;
+    ''',
+    # 3: keyset pagination of the explorer on (time, flag)
+    'DROP INDEX IF EXISTS idx_time; CREATE INDEX IF NOT EXISTS idx_time_flag ON flags (time, flag);',
+    # 4: distinct exploits, users and teams
+    '''
+    CREATE TABLE IF NOT EXISTS dimensions
+    (
+        kind  TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (kind, value)
+    ) WITHOUT ROWID;
+    INSERT OR IGNORE INTO dimensions (kind, value)
+    SELECT DISTINCT 'exploit_name', exploit_name FROM flags
+    UNION SELECT DISTINCT 'username', username FROM flags
+    UNION SELECT DISTINCT 'team_ip', team_ip FROM flags;
+    ''',
+    # 5: compact flags, see normalize_flags()
+    lambda: normalize_flags(),
+    # 6: archive of the old flags, which stay in the dashboard counters when they leave the flags table
+    '''
+    CREATE TABLE IF NOT EXISTS flags_archive
+    (
+        flag            TEXT PRIMARY KEY,
+        user_id         INTEGER NOT NULL REFERENCES dimensions (id),
+        exploit_id      INTEGER NOT NULL REFERENCES dimensions (id),
+        team_id         INTEGER NOT NULL REFERENCES dimensions (id),
+        time            INTEGER NOT NULL,
+        status          INTEGER NOT NULL,
+        server_response INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_archive_time_flag ON flags_archive (time, flag);
+    DROP TRIGGER IF EXISTS flags_rollup_delete;
+    CREATE TRIGGER flags_rollup_delete AFTER DELETE ON flags
+        WHEN NOT EXISTS (SELECT 1 FROM flags_archive WHERE flag = OLD.flag)
+    BEGIN
+        UPDATE flags_rollup SET count = count - 1
+        WHERE minute = OLD.time / 60 AND exploit_id = OLD.exploit_id AND team_id = OLD.team_id
+          AND status = OLD.status AND response = IFNULL(OLD.server_response, 0);
+    END;
+    ''',
+)
+
+
+def statuses():
+    """Values of the status column: their code is their index."""
+    return current_app.config['DB_NSUB'], current_app.config['DB_SUB']
+
+
+def responses():
+    """Values of the server_response column: their code is their index (0 means no response, NULL in flags)."""
+    return None, current_app.config['DB_ERR'], current_app.config['DB_EXP'], current_app.config['DB_SUCC']
+
+
+def status_code(name: str) -> int:
+    try:
+        return statuses().index(name)
+    except ValueError:
+        raise ValueError(f'Invalid status {name!r}')
+
+
+def response_code(name):
+    try:
+        return responses().index(name) or None
+    except ValueError:
+        raise ValueError(f'Invalid response {name!r}')
+
+
+def outcome_name(status: int, response) -> str:
+    """The server response, or the status if there is none (the old text value of COALESCE(server_response, status))."""
+    return responses()[response] if response else statuses()[status]
+
+
+def to_time(value) -> int:
+    """Unix time of a local 'YYYY-MM-DD HH:MM:SS' string (or of a number of seconds). Raises ValueError."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if not isinstance(value, str):
+        raise ValueError(f'Invalid time {value!r}')
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def format_time(value: int) -> str:
+    return datetime.fromtimestamp(value).isoformat(sep=' ')
+
+
+def normalize_flags():
+    """Integer ids (from dimensions) for users, exploits and teams, codes for status and server_response,
+    Unix time instead of text."""
+    def quote(value):
+        return "'" + value.replace("'", "''") + "'"
+
+    status_cases = ' '.join(f'WHEN {quote(name)} THEN {code}' for code, name in enumerate(statuses()))
+    response_cases = ' '.join(f'WHEN {quote(name)} THEN {code}' for code, name in enumerate(responses()) if code)
+    return f'''
+    DROP TRIGGER IF EXISTS flags_rollup_insert;
+    DROP TRIGGER IF EXISTS flags_rollup_update;
+    DROP TRIGGER IF EXISTS flags_rollup_delete;
+    DROP TABLE IF EXISTS flags_rollup;
+
+    ALTER TABLE dimensions RENAME TO dimensions_old;
+    CREATE TABLE dimensions
+    (
+        id    INTEGER PRIMARY KEY,
+        kind  TEXT NOT NULL,
+        value TEXT NOT NULL,
+        UNIQUE (kind, value)
+    );
+    INSERT INTO dimensions (kind, value) SELECT kind, value FROM dimensions_old ORDER BY kind, value;
+    DROP TABLE dimensions_old;
+
+    ALTER TABLE flags RENAME TO flags_old;
+    CREATE TABLE flags
+    (
+        flag            TEXT PRIMARY KEY,
+        user_id         INTEGER NOT NULL REFERENCES dimensions (id),
+        exploit_id      INTEGER NOT NULL REFERENCES dimensions (id),
+        team_id         INTEGER NOT NULL REFERENCES dimensions (id),
+        time            INTEGER NOT NULL,
+        status          INTEGER NOT NULL DEFAULT 0,
+        server_response INTEGER
+    );
+    INSERT INTO flags (flag, user_id, exploit_id, team_id, time, status, server_response)
+    SELECT f.flag, u.id, e.id, t.id, IFNULL(CAST(strftime('%s', f.time, 'utc') AS INTEGER), 0),
+           CASE f.status {status_cases} ELSE 0 END,
+           CASE f.server_response {response_cases} END
+    FROM flags_old f
+    JOIN dimensions u ON u.kind = 'username' AND u.value = f.username
+    JOIN dimensions e ON e.kind = 'exploit_name' AND e.value = f.exploit_name
+    JOIN dimensions t ON t.kind = 'team_ip' AND t.value = f.team_ip
+    ORDER BY f.rowid;
+    DROP TABLE flags_old;
+    CREATE INDEX idx_time_flag ON flags (time, flag);
+    CREATE INDEX idx_pending ON flags (status, server_response, time);
+
+    CREATE TABLE flags_rollup
+    (
+        minute     INTEGER NOT NULL,
+        exploit_id INTEGER NOT NULL,
+        team_id    INTEGER NOT NULL,
+        status     INTEGER NOT NULL,
+        response   INTEGER NOT NULL,
+        count      INTEGER NOT NULL,
+        PRIMARY KEY (minute, exploit_id, team_id, status, response)
+    ) WITHOUT ROWID;
+    INSERT INTO flags_rollup (minute, exploit_id, team_id, status, response, count)
+    SELECT time / 60, exploit_id, team_id, status, IFNULL(server_response, 0), COUNT(*)
+    FROM flags
+    GROUP BY 1, 2, 3, 4, 5;
+    CREATE TRIGGER flags_rollup_insert AFTER INSERT ON flags
+    BEGIN
+        INSERT INTO flags_rollup (minute, exploit_id, team_id, status, response, count)
+        VALUES (NEW.time / 60, NEW.exploit_id, NEW.team_id, NEW.status, IFNULL(NEW.server_response, 0), 1)
+        ON CONFLICT (minute, exploit_id, team_id, status, response) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER flags_rollup_update AFTER UPDATE OF status, server_response ON flags
+        WHEN OLD.status IS NOT NEW.status OR OLD.server_response IS NOT NEW.server_response
+    BEGIN
+        UPDATE flags_rollup SET count = count - 1
+        WHERE minute = OLD.time / 60 AND exploit_id = OLD.exploit_id AND team_id = OLD.team_id
+          AND status = OLD.status AND response = IFNULL(OLD.server_response, 0);
+        INSERT INTO flags_rollup (minute, exploit_id, team_id, status, response, count)
+        VALUES (NEW.time / 60, NEW.exploit_id, NEW.team_id, NEW.status, IFNULL(NEW.server_response, 0), 1)
+        ON CONFLICT (minute, exploit_id, team_id, status, response) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER flags_rollup_delete AFTER DELETE ON flags
+    BEGIN
+        UPDATE flags_rollup SET count = count - 1
+        WHERE minute = OLD.time / 60 AND exploit_id = OLD.exploit_id AND team_id = OLD.team_id
+          AND status = OLD.status AND response = IFNULL(OLD.server_response, 0);
+    END;
+    '''
+
+
+class ConnectionPool:
+    """Pool of configured SQLite connections, with read-only and read-write connections kept apart.
+
+    Request handlers check a connection out for the duration of the app context (threads of the
+    development server only live for one request, so connections can't be tied to them); long-running
+    threads like the ingest writer and the submission loop keep theirs for their whole life.
+    """
+
+    def __init__(self, database: str, size: int, cached_statements: int, synchronous: str):
+        self.database = database
+        self.size = size
+        self.cached_statements = cached_statements
+        self.synchronous = synchronous
+        self._idle = {False: [], True: []}
+        self._lock = threading.Lock()
+        self._hits = {False: 0, True: 0}
+        self._misses = {False: 0, True: 0}
+
+    def acquire(self, readonly=False) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle[readonly]:
+                self._hits[readonly] += 1
+                return self._idle[readonly].pop()
+            self._misses[readonly] += 1
+        return self._connect(readonly)
+
+    def release(self, connection: sqlite3.Connection, readonly=False):
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            if len(self._idle[readonly]) < self.size:
+                self._idle[readonly].append(connection)
+                return
+        connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                mode: {
+                    'hits': self._hits[readonly],
+                    'misses': self._misses[readonly],
+                    'idle': len(self._idle[readonly]),
+                } for mode, readonly in (('read_write', False), ('read_only', True))
+            }
+
+    def _connect(self, readonly):
+        if readonly:
+            connection = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True,
+                                         detect_types=sqlite3.PARSE_DECLTYPES,
+                                         cached_statements=self.cached_statements,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA query_only=1')
+        else:
+            connection = sqlite3.connect(self.database,
+                                         detect_types=sqlite3.PARSE_DECLTYPES,
+                                         cached_statements=self.cached_statements,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+        connection.row_factory = sqlite3.Row
+        connection.execute(f'PRAGMA synchronous={self.synchronous}')
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+
+def get_pool() -> ConnectionPool:
+    return current_app.extensions['db_pool']
+
+
+def get_db(readonly=False):
+    key = 'db_ro' if readonly else 'db'
+    if key not in g:
+        setattr(g, key, get_pool().acquire(readonly))
+
+    return g.get(key)
 
 
 # noinspection PyUnusedLocal
 def close_db(e=None):  # e is for error handling
-    db = g.pop('db', None)
+    for key, readonly in (('db', False), ('db_ro', True)):
+        db = g.pop(key, None)
 
-    if db is not None:
-        db.close()
+        if db is not None:
+            get_pool().release(db, readonly)
 
 
 def init_db():
     db = get_db()
 
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'flags'").fetchone() is not None:
+        migrate(db)
+        return
+
     with current_app.open_resource('schema.sql') as schema:
         db.executescript(schema.read().decode('UTF-8'))
+    db.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+
+
+def migrate(db):
+    """Bring a database created by an older schema.sql up to date. Returns the schema version."""
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    for version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        current_app.logger.info(f'Migrating the database to version {version}')
+        if callable(script):
+            script = script()
+        db.executescript(f'BEGIN; {script} PRAGMA user_version = {version}; COMMIT;')
+    return version
 
 
-@click.command('init-db')
+@click.command('migrate-db')
 @with_appcontext
-def init_db_command():
-    init_db()
-    click.echo('Initialized the database.')
+def migrate_db_command():
+    version = migrate(get_db())
+    click.echo(f'The database schema is at version {version}.')
 
 
 def init_app(app):
+    if app.config['DB_SYNCHRONOUS'] not in ('FULL', 'NORMAL'):
+        raise ValueError(f"Invalid DB_SYNCHRONOUS {app.config['DB_SYNCHRONOUS']}. Valid values are ['FULL', 'NORMAL']")
+    app.extensions['db_pool'] = ConnectionPool(app.config['DATABASE'],
+                                               app.config['DB_POOL_SIZE'],
+                                               app.config['DB_CACHED_STATEMENTS'],
+                                               app.config['DB_SYNCHRONOUS'])
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+from flask import current_app
+
+QueuedFlag = namedtuple('QueuedFlag', ['flag', 'time', 'exploit_name', 'team_ip'])
+
+
+class NewestFirst:
+    """LIFO: the last flags to arrive are the first to be sent."""
+
+    def __init__(self):
+        self._items = OrderedDict()  # flag -> QueuedFlag, in arrival order
+
+    def push(self, item):
+        self._items[item.flag] = item
+
+    def pop(self):
+        return self._items.popitem(last=True)[1]
+
+    def prune(self, expiration):
+        # Arrival order is close to time order, so the expired flags are (mostly) at the front
+        pruned = []
+        while self._items and next(iter(self._items.values())).time <= expiration:
+            pruned.append(self._items.popitem(last=False)[1])
+        return pruned
+
+    def __len__(self):
+        return len(self._items)
+
+
+class EarliestDeadlineFirst:
+    """The flags closest to expiring are sent first."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def push(self, item):
+        heapq.heappush(self._heap, (item.time, next(self._counter), item))
+
+    def pop(self):
+        return heapq.heappop(self._heap)[2]
+
+    def prune(self, expiration):
+        pruned = []
+        while self._heap and self._heap[0][0] <= expiration:
+            pruned.append(heapq.heappop(self._heap)[2])
+        return pruned
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class RoundRobin:
+    """Takes turns between (exploit, team) pairs, earliest deadline first within each of them.
+
+    A very productive exploit against a single team can't fill whole payloads while other flags wait.
+    """
+
+    def __init__(self):
+        self._groups = {}  # (exploit_name, team_ip) -> EarliestDeadlineFirst
+        self._turns = deque()
+        self._size = 0
+
+    def push(self, item):
+        key = (item.exploit_name, item.team_ip)
+        if key not in self._groups:
+            self._groups[key] = EarliestDeadlineFirst()
+            self._turns.append(key)
+        self._groups[key].push(item)
+        self._size += 1
+
+    def pop(self):
+        key = self._turns.popleft()
+        group = self._groups[key]
+        item = group.pop()
+        if group:
+            self._turns.append(key)
+        else:
+            del self._groups[key]
+        self._size -= 1
+        return item
+
+    def prune(self, expiration):
+        pruned = []
+        for key in list(self._turns):
+            group = self._groups[key]
+            pruned += group.prune(expiration)
+            if not group:
+                del self._groups[key]
+                self._turns.remove(key)
+        self._size -= len(pruned)
+        return pruned
+
+    def __len__(self):
+        return self._size
+
+
+policies = {
+    'newest': NewestFirst,
+    'edf': EarliestDeadlineFirst,
+    'round_robin': RoundRobin,
+}
+
+
+class FlagQueue:
+    """Flags waiting to be submitted.
+
+    Kept in memory for the whole life of the submission loop: it is filled from the database once at
+    startup and then fed by the ingest writer as soon as new flags are committed.
+    Unique and thread-safe; the order in which flags are sent is decided by the policy (see `policies`).
+    """
+
+    def __init__(self, policy: str):
+        self.policy = policy
+        self._items = policies[policy]()
+        self._flags = set()
+        self._not_empty = threading.Condition()
+        self._woken = False
+        self._expired_items = []
+        self.sent = 0
+        self.expired = 0  # flags that expired while waiting in the queue
+
+    def put_many(self, items):
+        with self._not_empty:
+            for item in items:
+                if item.flag not in self._flags:
+                    self._flags.add(item.flag)
+                    self._items.push(item)
+            if self._flags:
+                self._not_empty.notify_all()
+
+    def get_batch(self, size: int, expiration: int):
+        """Pop up to `size` flags, skipping (and dropping) the ones with time <= expiration."""
+        batch = []
+        with self._not_empty:
+            while self._items and len(batch) < size:
+                item = self._items.pop()
+                self._flags.discard(item.flag)
+                if item.time > expiration:
+                    batch.append(item)
+                else:
+                    self._expired_items.append(item)
+                    self.expired += 1
+            self.sent += len(batch)
+        return batch
+
+    def prune(self, expiration: int):
+        """Drop expired flags, so that they don't pile up when the queue never drains."""
+        with self._not_empty:
+            pruned = self._items.prune(expiration)
+            self._flags.difference_update(item.flag for item in pruned)
+            self._expired_items += pruned
+            self.expired += len(pruned)
+
+    def pop_expired(self):
+        """Returns (and forgets) the flags dropped because they expired since the last call."""
+        with self._not_empty:
+            expired, self._expired_items = self._expired_items, []
+        return expired
+
+    def wait(self, timeout: float, wake_on_empty=False) -> bool:
+        """Block until the queue is not empty, or until the timeout expires. Returns True if there are flags.
+
+        With wake_on_empty, wake() also ends the wait.
+        """
+        with self._not_empty:
+            self._not_empty.wait_for(lambda: self._flags or (wake_on_empty and self._woken), timeout=timeout)
+            self._woken = False
+            return bool(self._flags)
+
+    def wait_for_completion(self, timeout: float):
+        """Block until wake() is called or the timeout expires, whatever the queue holds.
+
+        For when flags are waiting but no more requests can be sent until one in flight completes.
+        """
+        with self._not_empty:
+            self._not_empty.wait_for(lambda: self._woken, timeout=timeout)
+            self._woken = False
+
+    def wake(self):
+        with self._not_empty:
+            self._woken = True
+            self._not_empty.notify_all()
+
+    def stats(self):
+        with self._not_empty:
+            return {'policy': self.policy, 'queued': len(self._items), 'sent': self.sent, 'expired': self.expired}
+
+    def __len__(self):
+        return len(self._items)
+
+
+def get_queue() -> FlagQueue:
+    return current_app.extensions['flag_queue']
+
+
+def init_app(app):
+    if app.config['SUB_PRIORITY'] not in policies:
+        raise ValueError(f"Invalid SUB_PRIORITY {app.config['SUB_PRIORITY']}. Valid values are {list(policies)}")
+    app.extensions['flag_queue'] = FlagQueue(app.config['SUB_PRIORITY'])
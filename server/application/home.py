@@ -1,58 +1,22 @@
-import collections
-import functools
-import gzip
-from datetime import datetime, timedelta
-from io import BytesIO
+import base64
+import csv
+import io
+import itertools
+import queue
+import time
 
 from flask import (
-    Blueprint, render_template, request, after_this_request, current_app, jsonify
+    Blueprint, render_template, request, current_app, jsonify, json, Response, stream_with_context
 )
 
-from . import db
+from . import cache, db, storage, stream
 from .auth import login_required
 
 bp = Blueprint('home', __name__)
 
 
-# Slower on localhost, might save your life in any other setting.
-# Don't waste your bandwidth, kids.
-def gzipped(f):
-    @functools.wraps(f)
-    def view_func(*args, **kwargs):
-        @after_this_request
-        def zipper(response):
-            accept_encoding = request.headers.get('Accept-Encoding', '')
-
-            if 'gzip' not in accept_encoding.lower():
-                return response
-
-            response.direct_passthrough = False
-
-            if (response.status_code < 200 or
-                    response.status_code >= 300 or
-                    'Content-Encoding' in response.headers):
-                return response
-            gzip_buffer = BytesIO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(response.data)
-            gzip_file.close()
-
-            response.data = gzip_buffer.getvalue()
-            response.headers['Content-Encoding'] = 'gzip'
-            response.headers['Vary'] = 'Accept-Encoding'
-            response.headers['Content-Length'] = len(response.data)
-
-            return response
-
-        return f(*args, **kwargs)
-
-    return view_func
-
-
 @bp.route('/', methods=['GET'])
 @login_required
-@gzipped
 def index():
     return render_template('index.html')
 
@@ -65,163 +29,179 @@ def chart_data():
         exploit_filter = request.args.get('exploitFilter', '').strip()
     except (ValueError, TypeError):
         return "<h1>Bad request</h1>", 400
-    now = datetime.now()
-    start = now - timedelta(minutes=mins)
-    expiration = now - timedelta(seconds=current_app.config['FLAG_ALIVE'])
-    start_s = start.replace(microsecond=0).isoformat(sep=' ')
-    expiration_s = expiration.replace(microsecond=0).isoformat(sep=' ')
-    cur = db.get_db().cursor()
-    if mins != 0:
-        cur.execute('''
-            SELECT
-                SUM(server_response LIKE 'SUCCESS') as accepted,
-                SUM(server_response LIKE 'ERROR') as error,
-                SUM(status LIKE 'NOT_SUBMITTED' AND server_response IS NULL) AS queued,
-                SUM(server_response LIKE 'EXPIRED') AS expired
-            FROM flags
-            WHERE time >= ?;
-            ''', (start_s,)
-                    )
-        doughnut_row = cur.fetchone()
-        cur.execute('''
-            SELECT
-               exploit_name,
-               SUM(server_response LIKE 'SUCCESS') AS accepted,
-               SUM(server_response LIKE 'ERROR') AS error,
-               MIN(time) AS first_occurrence_in_timeframe
-            FROM (
-                SELECT exploit_name, server_response, time
-                FROM flags
-                WHERE time >= ?
-            )
-            GROUP BY exploit_name
-            ORDER BY first_occurrence_in_timeframe
-            ''', (start_s,))
-        barsExploit_rows = cur.fetchall()
-        exploit_filter_query = "AND exploit_name = :exploit" if exploit_filter else ""
-        cur.execute(f'''
-            SELECT
-               team_ip,
-               SUM(server_response LIKE 'SUCCESS') AS accepted,
-               SUM(server_response LIKE 'ERROR') AS error
-            FROM flags
-            WHERE time >= :time {exploit_filter_query}
-            GROUP BY team_ip
-            ORDER BY team_ip
-            ''', {"time": start_s, "exploit": exploit_filter})
-        barsTeams_rows = cur.fetchall()
+
+    # All the dashboards looking at the same data share the same response, and get a 304 if they already have it
+    chart_cache = cache.get_chart_cache()
+    etag, body = chart_cache.get((mins, exploit_filter),
+                                 lambda: json.dumps(compute_chart_data(mins, exploit_filter)).encode())
+    if request.if_none_match.contains(etag):
+        chart_cache.not_modified()
+        response = current_app.response_class(status=304)
     else:
-        cur.execute('''
-            SELECT
-                SUM(server_response LIKE 'SUCCESS') as accepted,
-                SUM(server_response LIKE 'ERROR') as error,
-                SUM(status LIKE 'NOT_SUBMITTED' AND time >= ?) AS queued,
-                SUM(status LIKE 'NOT_SUBMITTED' AND time < ?) AS expired
-            FROM flags
-            ''', (expiration_s, expiration_s)
-                    )
-        doughnut_row = cur.fetchone()
-        cur.execute('''
-            SELECT
-               exploit_name,
-               SUM(server_response LIKE 'SUCCESS') AS accepted,
-               SUM(server_response LIKE 'ERROR') AS error,
-               MIN(time) AS first_occurrence
-            FROM flags
-            GROUP BY exploit_name
-            ORDER BY first_occurrence
-            ''')
-        barsExploit_rows = cur.fetchall()
-        exploit_filter_query = "WHERE exploit_name = :exploit" if exploit_filter else ""
-        cur.execute(f'''
-            SELECT
-               team_ip,
-               SUM(server_response LIKE 'SUCCESS') AS accepted,
-               SUM(server_response LIKE 'ERROR') AS error,
-               MIN(time) AS first_occurrence
-            FROM flags {exploit_filter_query}
-            GROUP BY team_ip
-            ORDER BY team_ip
-            ''', {"exploit": exploit_filter})
-        barsTeams_rows = cur.fetchall()
-
-    doughnut_dict = {
-        'accepted': doughnut_row[0],
-        'error': doughnut_row[1],
-        'queued': doughnut_row[2],
-        'expired': doughnut_row[3]
-    }
-    barsExploit_arr = []
-    for row in barsExploit_rows:
-        barsExploit_arr.append({
-            'name': row[0],
-            'accepted': row[1],
-            'error': row[2]
-        })
-    barsTeams_arr = []
-    for row in barsTeams_rows:
-        barsTeams_arr.append({
-            'name': row[0],
-            'accepted': row[1],
-            'error': row[2]
-        })
-
-    objects_dict = {'doughnutStatus': doughnut_dict, 'barsExploit': barsExploit_arr, 'barsTeams': barsTeams_arr}
-    return jsonify(objects_dict)
+        response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@bp.route('/index/stream', methods=['GET'])
+@login_required
+def chart_stream():
+    """Server-Sent Events with the changes of the dashboard counters, see stream.ChartStream.
+
+    Each event is {"changes": [[minutes ago, exploit, team, status, delta], ...], "queued": queue length}.
+    """
+    chart_stream = stream.get_stream()
+    messages = chart_stream.subscribe()
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield f'data: {messages.get(timeout=15)}\n\n'
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            chart_stream.unsubscribe(messages)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def compute_chart_data(mins: int, exploit_filter: str):
+    now = int(time.time())
+    return storage.get_storage().chart_data(now - 60 * mins if mins != 0 else None,
+                                            now - current_app.config['FLAG_ALIVE'], exploit_filter)
 
 
 @bp.route('/explore', methods=['GET'])
 @login_required
-@gzipped
 def explore():
-    cur = db.get_db().cursor()
-    cur.execute('SELECT DISTINCT exploit_name FROM flags ORDER BY exploit_name DESC')
-    exploits_names = [res[0] for res in cur.fetchall()]
-    cur.execute('SELECT DISTINCT username FROM flags ORDER BY username DESC')
-    usernames = [res[0] for res in cur.fetchall()]
-    cur.execute('SELECT DISTINCT team_ip FROM flags ORDER BY team_ip DESC')
-    team_ips = [res[0] for res in cur.fetchall()]
-
-    return render_template('explore.html', exploits_names=exploits_names, usernames=usernames, team_ips=team_ips,
+    dimensions = storage.get_storage().dimension_values()
+
+    return render_template('explore.html', exploits_names=dimensions['exploit_name'],
+                           usernames=dimensions['username'], team_ips=dimensions['team_ip'],
                            statuses=[current_app.config['DB_SUB'], current_app.config['DB_NSUB']],
                            responses=[current_app.config['DB_SUCC'], current_app.config['DB_ERR'], current_app.config['DB_EXP']],
                            db_nsub=current_app.config['DB_NSUB'])
 
 
+PAGING_ARGS = {'limit', 'offset', 'after', 'sort', 'order', 'search'}
+MAX_PAGE_SIZE = 1000
+
+
+def explorer_filters(args, ignore=PAGING_ARGS):
+    """Storage filters for the explorer filters in args.
+    Raises KeyError for unknown filters, ValueError for invalid times."""
+    filters = {}
+    for k, v in args.items():
+        if k in ignore or v == '':
+            continue
+        filters[k] = db.to_time(v) if storage.FILTERS[k] is int else v
+    return filters
+
+
+def encode_cursor(value, flag):
+    return base64.urlsafe_b64encode(json.dumps([value, flag]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    value, flag = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, flag
+
+
+def flag_values(row):
+    """Storage row with the time as it is shown."""
+    return (*row[:4], db.format_time(row[4]), *row[5:7])
+
+
+def flag_dict(row):
+    return dict(zip(('flag', 'username', 'exploit_name', 'team_ip', 'time', 'status', 'response'), flag_values(row)))
+
+
 @bp.route('/explore/get_flags', methods=['GET'])
 @login_required
-@gzipped
-# FIXME: This works, but it's *really* ugly.
-#        There must be a better way to do this.
 def explore_get_flags():
-    statement = 'SELECT * FROM flags'
-    where = []
-    for k, v in request.args.items():
-        if v != '':
-            if k == 'since':
-                where.append("time >= '" + v + "'")
-            elif k == 'until':
-                where.append("time <= '" + v + "'")
-            else:
-                where.append(k + ' = ' + "'" + v + "'")
-    if where:
-        statement = '{} WHERE {}'.format(statement, ' AND '.join(where))
-
-    cur = db.get_db().cursor()
-    # current_app.logger.debug(f"executing query {statement}")
-    cur.execute(statement)
-    rows = cur.fetchall()
-    objects_list = []
-    for row in rows:
-        d = collections.OrderedDict()
-        d['flag'] = row[0]
-        d['username'] = row[1]
-        d['exploit_name'] = row[2]
-        d['team_ip'] = row[3]
-        d['time'] = row[4]
-        d['status'] = row[5]
-        d['response'] = row[6]
-        objects_list.append(d)
-
-    # current_app.logger.debug(f"sending {len(rows)} rows.")
-    return jsonify(objects_list)
+    """Flags matching the filters in the query string.
+
+    With `limit`, one page of them: {'rows', 'total', 'estimated', 'next'}. The page after this one is
+    requested by passing `next` as `after` (keyset pagination, cheap however deep the page is); `offset` is
+    also accepted for jumps. Without `limit`, all of them as a list.
+    """
+    try:
+        filters = explorer_filters(request.args)
+        limit = request.args.get('limit', type=int)
+        offset = request.args.get('offset', 0, type=int)
+        sort = request.args.get('sort') or 'time'
+        if sort not in storage.SORTS:
+            raise KeyError(sort)
+        descending = request.args.get('order', 'desc').lower() != 'asc'
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+    except (KeyError, ValueError, TypeError):
+        return "<h1>Bad request</h1>", 400
+
+    flags = storage.get_storage()
+    if limit is None:
+        return jsonify([flag_dict(row) for row in flags.explore(filters, sort, descending, None, 0, None)])
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if after is not None:
+        offset = 0
+    rows = flags.explore(filters, sort, descending, limit, offset, after)
+    total, estimated = flags.count(filters)
+    return jsonify({
+        'rows': [flag_dict(row) for row in rows],
+        'total': total,
+        'estimated': estimated,
+        'next': encode_cursor(rows[-1][7], rows[-1][0]) if len(rows) == limit else None,
+    })
+
+
+EXPORT_COLUMNS = ('flag', 'username', 'exploit_name', 'team_ip', 'time', 'status', 'server_response')
+EXPORT_CHUNK_ROWS = 1000
+
+
+def export_chunks(rows, fmt):
+    """Encode the rows of the iterator, EXPORT_CHUNK_ROWS at a time."""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_ROWS))
+        if not chunk:
+            return
+        if fmt == 'csv':
+            writer.writerows(flag_values(row) for row in chunk)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, flag_values(row)))) + '\n' for row in chunk).encode()
+
+
+@bp.route('/explore/export', methods=['GET'])
+@login_required
+def explore_export():
+    """All the flags matching the explorer filters, as CSV or NDJSON (format=csv|ndjson).
+
+    Rows are read from the storage and sent (and compressed, see compress.py) a chunk at a time, so memory use
+    doesn't depend on their number.
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        filters = explorer_filters(request.args, ignore={'format'})
+    except (KeyError, ValueError):
+        return "<h1>Bad request</h1>", 400
+    if fmt not in ('csv', 'ndjson'):
+        return "<h1>Bad request</h1>", 400
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    # The context keeps the database connection checked out until the last chunk is sent
+    rows = storage.get_storage().export(filters)
+    return Response(stream_with_context(export_chunks(rows, fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=flags.{fmt}'})
@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+from flask import Flask, current_app
+
+from . import db, storage
+
+
+class GroupCommitWriter:
+    """Single writer for flag uploads.
+
+    Uploads are queued and coalesced into one transaction every INGEST_MAX_DELAY seconds
+    (or as soon as INGEST_MAX_ROWS rows are pending). Rows are (flag, username, exploit_name, team_ip,
+    Unix time, status), stored with Storage.insert_batch(). The future returned by submit() resolves to
+    the number of inserted rows once the transaction is committed.
+    Callbacks registered with subscribe() are then called with the list of inserted rows.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.max_delay = app.config['INGEST_MAX_DELAY']
+        self.max_rows = app.config['INGEST_MAX_ROWS']
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def submit(self, rows) -> Future:
+        future = Future()
+        self._ensure_started()
+        self._queue.put((rows, future))
+        return future
+
+    def _ensure_started(self):
+        # Started lazily, so that CLI commands like init-db don't spawn a writer
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='ingest_writer')
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            flags = storage.get_storage()
+            while True:
+                batch = [self._queue.get()]
+                pending = len(batch[0][0])
+                deadline = time.monotonic() + self.max_delay
+                while pending < self.max_rows:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except Empty:
+                        break
+                    batch.append(item)
+                    pending += len(item[0])
+
+                # Whatever goes wrong, the writer keeps running: the uploads that failed get the exception
+                try:
+                    self._commit(flags, batch)
+                except Exception as e:
+                    if len(batch) == 1:
+                        self._fail(batch[0], e)
+                        continue
+                    # Don't let a single bad upload fail everybody else's
+                    current_app.logger.warning(f'ingest: group commit failed ({e!r}), retrying uploads one by one')
+                    for item in batch:
+                        try:
+                            self._commit(flags, [item])
+                        except Exception as e:
+                            self._fail(item, e)
+
+    @staticmethod
+    def _fail(item, e):
+        if not isinstance(e, storage.get_storage().ERRORS):
+            current_app.logger.error(f'ingest: upload of {len(item[0])} flags failed: {e!r}')
+        if not item[1].done():
+            item[1].set_exception(e)
+
+    def _commit(self, flags, batch):
+        inserted = flags.insert_batch([rows for rows, _ in batch])
+        for (_, future), new_rows in zip(batch, inserted):
+            future.set_result(len(new_rows))
+
+        new_rows = [row for rows in inserted for row in rows]
+        for callback in self._subscribers:
+            try:
+                callback(new_rows)
+            except Exception as e:
+                current_app.logger.error(f'ingest: subscriber {callback} failed: {e}')
+
+
+class RecentFlags:
+    """Bounded set of recently uploaded flags.
+
+    Flags are forgotten after `ttl` seconds, or earlier (oldest first) when more than `maxsize` are stored.
+    Thread-safe.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._flags = OrderedDict()  # flag -> expiration, in insertion order
+        self._lock = threading.Lock()
+
+    def unseen(self, flags):
+        with self._lock:
+            self._evict()
+            return [flag for flag in flags if flag not in self._flags]
+
+    def add(self, flags):
+        expiration = time.monotonic() + self.ttl
+        with self._lock:
+            for flag in flags:
+                self._flags[flag] = expiration
+                self._flags.move_to_end(flag)
+            self._evict()
+
+    def __len__(self):
+        return len(self._flags)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._flags:
+            flag, expiration = next(iter(self._flags.items()))
+            if expiration > now and len(self._flags) <= self.maxsize:
+                break
+            del self._flags[flag]
+
+
+def get_writer() -> GroupCommitWriter:
+    return current_app.extensions['ingest_writer']
+
+
+def get_recent_flags() -> RecentFlags:
+    return current_app.extensions['recent_flags']
+
+
+def store_flags(rows) -> int:
+    """Store (flag, username, exploit_name, team_ip, time, status) rows, skipping recently seen flags.
+
+    Returns the number of flags that were not already in the database.
+    Raises ValueError if a flag, username, exploit name or team is missing or not a string, if a time or
+    a status is invalid, and concurrent.futures.TimeoutError if the rows
+    are not committed within INGEST_TIMEOUT seconds.
+    """
+    for row in rows:
+        for field, value in zip(('flag', 'username', 'exploit_name', 'team_ip'), row):
+            if not isinstance(value, str) or not value:
+                raise ValueError(f'Invalid {field} {value!r}')
+
+    recent_flags = get_recent_flags()
+    unique = {}
+    for row in rows:
+        unique.setdefault(row[0], row)
+    unseen = recent_flags.unseen(unique)
+    if not unseen:
+        return 0
+
+    rows = [(*unique[flag][:4], db.to_time(unique[flag][4]), unique[flag][5]) for flag in unseen]
+    for row in rows:
+        db.status_code(row[5])  # raises ValueError for an unknown status
+    inserted = get_writer().submit(rows).result(timeout=current_app.config['INGEST_TIMEOUT'])
+    recent_flags.add(unseen)
+    return inserted
+
+
+def init_app(app):
+    app.extensions['ingest_writer'] = GroupCommitWriter(app)
+    app.extensions['recent_flags'] = RecentFlags(app.config['FLAG_ALIVE'], app.config['DEDUP_MAX_FLAGS'])
@@ -0,0 +1,159 @@
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+from . import db
+
+
+class Maintenance:
+    """Scheduled database upkeep: WAL checkpoints, statistics for the query planner and online backups.
+
+    Runs in a single thread, started with the submission loop (in only one process, see acquire_lock):
+    - every CHECKPOINT_INTERVAL seconds, a passive checkpoint, which never waits for readers or writers.
+      When the WAL is larger than WAL_TRUNCATE_SIZE and has been checkpointed in full, it is truncated;
+    - every OPTIMIZE_INTERVAL seconds, PRAGMA optimize (a sampled ANALYZE before SQLite 3.46);
+    - every BACKUP_INTERVAL seconds (if not 0), a backup in BACKUP_DIR, copied BACKUP_STEP_PAGES at a time.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+            'wal_bytes': None,
+            'checkpoint': {'runs': 0, 'truncated': 0, 'busy': 0, 'last_ms': None, 'frames': None, 'checkpointed': None},
+            'optimize': {'runs': 0, 'last_ms': None},
+            'backup': {'runs': 0, 'running': False, 'pages': None, 'remaining': None, 'last_ms': None, 'last': None},
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='db_maintenance')
+                self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) if isinstance(v, dict) else v for k, v in self._stats.items()}
+
+    def _update(self, task, **values):
+        with self._lock:
+            self._stats[task].update(values)
+
+    def _run(self):
+        with self.app.app_context():
+            database = db.get_db()
+            now = time.monotonic()
+            due = {
+                self.checkpoint: now,
+                self.optimize: now + current_app.config['OPTIMIZE_INTERVAL'],
+                self.backup: now + current_app.config['BACKUP_INTERVAL'],
+            }
+            intervals = {
+                self.checkpoint: current_app.config['CHECKPOINT_INTERVAL'],
+                self.optimize: current_app.config['OPTIMIZE_INTERVAL'],
+                self.backup: current_app.config['BACKUP_INTERVAL'],
+            }
+            for task in [task for task in due if not intervals[task]]:
+                del due[task]
+            while due:
+                task = min(due, key=due.get)
+                time.sleep(max(0.0, due[task] - time.monotonic()))
+                try:
+                    task(database)
+                except (sqlite3.Error, OSError) as e:
+                    current_app.logger.warning(f'maintenance: {task.__name__} failed: {e}')
+                due[task] = time.monotonic() + intervals[task]
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(current_app.config['DATABASE'] + '-wal')
+        except OSError:
+            return 0
+
+    def checkpoint(self, database):
+        s_time = time.monotonic()
+        busy, frames, checkpointed = database.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        truncated = False
+        if not busy and frames == checkpointed and self.wal_size() > current_app.config['WAL_TRUNCATE_SIZE']:
+            # Nothing left to copy: only waits (briefly) for the readers still using the WAL
+            busy_timeout = database.execute('PRAGMA busy_timeout').fetchone()[0]
+            database.execute('PRAGMA busy_timeout = 100')
+            try:
+                truncated = database.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0] == 0
+            finally:
+                database.execute(f'PRAGMA busy_timeout = {busy_timeout}')
+        with self._lock:
+            stats = self._stats['checkpoint']
+            stats['runs'] += 1
+            stats['truncated'] += truncated
+            stats['busy'] += busy
+            stats['last_ms'] = round((time.monotonic() - s_time) * 1000, 1)
+            stats['frames'] = frames
+            stats['checkpointed'] = checkpointed
+            self._stats['wal_bytes'] = self.wal_size()
+
+    def optimize(self, database):
+        s_time = time.monotonic()
+        database.execute('PRAGMA analysis_limit = 1000')  # rows sampled per index
+        if sqlite3.sqlite_version_info >= (3, 46):
+            # 0x10002: every table whose statistics are stale, not only the ones queried by this connection
+            database.execute('PRAGMA optimize = 0x10002')
+        else:
+            database.execute('ANALYZE')
+        with self._lock:
+            self._stats['optimize']['runs'] += 1
+            self._stats['optimize']['last_ms'] = round((time.monotonic() - s_time) * 1000, 1)
+
+    def backup(self, database=None):
+        """Copy the database to BACKUP_DIR, keeping the last BACKUP_KEEP copies. Returns the path of the copy."""
+        directory = os.path.join(current_app.instance_path, current_app.config['BACKUP_DIR'])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime('flagWarehouse-%Y%m%d-%H%M%S.sqlite'))
+        s_time = time.monotonic()
+        self._update('backup', running=True, pages=None, remaining=None)
+        source = db.get_pool().acquire(readonly=True)
+        target = sqlite3.connect(path + '.tmp')
+        try:
+            # The read transaction pins a snapshot: without it, every commit of the writers between two steps
+            # would restart the copy. Readers don't block writers with WAL.
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+            source.backup(target, pages=current_app.config['BACKUP_STEP_PAGES'],
+                          progress=lambda status, remaining, total: self._update('backup', pages=total,
+                                                                                 remaining=remaining))
+        finally:
+            target.close()
+            db.get_pool().release(source, readonly=True)
+            self._update('backup', running=False)
+        os.replace(path + '.tmp', path)
+        for old in sorted(glob.glob(os.path.join(directory, 'flagWarehouse-*.sqlite')))[:-current_app.config['BACKUP_KEEP']]:
+            os.remove(old)
+        with self._lock:
+            stats = self._stats['backup']
+            stats['runs'] += 1
+            stats['last_ms'] = round((time.monotonic() - s_time) * 1000, 1)
+            stats['last'] = os.path.basename(path)
+        return path
+
+
+def get_maintenance() -> Maintenance:
+    return current_app.extensions['db_maintenance']
+
+
+@click.command('backup-db')
+@with_appcontext
+def backup_db_command():
+    """Take an online backup of the database now."""
+    click.echo(f'Database copied to {get_maintenance().backup()}.')
+
+
+def init_app(app):
+    app.extensions['db_maintenance'] = Maintenance(app)
+    app.cli.add_command(backup_db_command)
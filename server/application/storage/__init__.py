@@ -0,0 +1,38 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .base import Storage, FILTERS, SORTS, MAX_EXACT_COUNT, archive_time
+from .memory import MemoryStorage
+from .postgres import PostgresStorage
+from .sqlite import SQLiteStorage
+
+# Values of STORAGE
+engines = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage,
+    'postgres': PostgresStorage,
+}
+
+
+def get_storage() -> Storage:
+    return current_app.extensions['storage']
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    get_storage().init()
+    click.echo('Initialized the database.')
+
+
+def init_app(app):
+    engine = app.config['STORAGE']
+    if engine not in engines:
+        raise ValueError(f'Unknown storage {engine!r}, expected one of {", ".join(engines)}')
+    storage = engines[engine](app)
+    if not storage.shared and app.config['SUBMITTER'] == 'process':
+        raise ValueError(f"The standalone submitter can't see the flags of STORAGE = {engine!r}: "
+                         f"use SUBMITTER = 'thread'")
+    app.extensions['storage'] = storage
+    app.cli.add_command(init_db_command)
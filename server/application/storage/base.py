@@ -0,0 +1,108 @@
+import time
+
+from flask import Flask, current_app
+
+# Explorer filters: field -> type of the value (since and until are Unix times)
+FILTERS = {
+    'exploit_name': str,
+    'username': str,
+    'team_ip': str,
+    'status': str,
+    'server_response': str,
+    'since': int,
+    'until': int,
+}
+SORTS = ('time', 'username', 'exploit_name', 'team_ip', 'status', 'response')
+MAX_EXACT_COUNT = 10000  # beyond this, the number of matching flags is estimated
+
+
+def archive_time() -> int:
+    """Flags with a server response and a time up to this one can be moved out of the way (see archive.py)."""
+    return int(time.time()) - max(current_app.config['FLAG_ALIVE'],
+                                  current_app.config['ARCHIVE_AFTER_ROUNDS'] * current_app.config['ROUND_DURATION'])
+
+
+class Storage:
+    """Where the flags are kept: every read and write of the application goes through one of these.
+
+    Flags come out as (flag, username, exploit_name, team_ip, time, status, server_response) rows, with Unix
+    times, and the DB_* names for status and server_response (None until the gameserver answers).
+    Filters are {field of FILTERS: value}. Methods are called from several threads at once, in an app context.
+    """
+
+    # Errors of the engine that a smaller transaction could avoid (the ingest writer retries uploads one by one)
+    ERRORS = ()
+    # Whether other processes see the same flags: the standalone submitter (SUBMITTER = 'process') needs it
+    shared = True
+
+    def __init__(self, app: Flask):
+        self.app = app
+
+    def init(self):
+        """Create the tables, or bring them up to date."""
+
+    def insert_batch(self, uploads):
+        """Store the (flag, username, exploit_name, team_ip, time, status) rows of each upload, in one transaction.
+
+        Flags already stored are skipped. Returns the list of inserted rows of each upload.
+        """
+        raise NotImplementedError()
+
+    def submittable(self, since: int):
+        """(flag, time, exploit_name, team_ip) of the flags never submitted with time > since, oldest first."""
+        raise NotImplementedError()
+
+    def new_flags(self, after):
+        """Flags never submitted inserted after the position `after` (None: the current end), by any process.
+
+        Returns (new position, [(flag, time, exploit_name, team_ip)]).
+        """
+        raise NotImplementedError()
+
+    def write_results(self, results):
+        """Mark the flags of the (flag, server_response) pairs as submitted, in one transaction."""
+        raise NotImplementedError()
+
+    def expire(self, since: int, until: int, flags=()):
+        """Give DB_EXP as response to the flags never submitted with since < time <= until, and to `flags`."""
+        raise NotImplementedError()
+
+    def archive(self, until: int, limit: int) -> int:
+        """Move up to `limit` flags with a server response and time <= until out of the hot data.
+
+        Returns the number of moved flags: 0 for the engines that don't need it.
+        """
+        return 0
+
+    def chart_data(self, since, expiration: int, exploit_filter: str):
+        """The dashboard: flags with time >= since (all of them if since is None), the ones never submitted
+        with time < expiration being counted as expired.
+        """
+        raise NotImplementedError()
+
+    def counters(self, since_minute: int):
+        """{(minute, exploit_name, team_ip, outcome): count} from minute since_minute (Unix time / 60) on.
+
+        The outcome is the server response, or the status if there is none.
+        """
+        raise NotImplementedError()
+
+    def dimension_values(self):
+        """All the exploits, users and teams seen so far: {kind: [values, sorted in descending order]}."""
+        raise NotImplementedError()
+
+    def explore(self, filters, sort: str, descending: bool, limit, offset: int, after):
+        """Flags matching the filters, sorted by the field `sort` of SORTS, then by flag.
+
+        With limit=None, all of them. `after` is None or the (sort value, flag) of the last row of the
+        previous page. Rows have their sort value as an eighth element.
+        """
+        raise NotImplementedError()
+
+    def count(self, filters):
+        """Returns (number of flags matching the filters, whether it's an estimate)."""
+        raise NotImplementedError()
+
+    def export(self, filters):
+        """Iterator over the flags matching the filters, by time then flag."""
+        raise NotImplementedError()
@@ -0,0 +1,186 @@
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app
+
+from .base import Storage
+
+# Position of the fields in the stored flags (flag -> [username, exploit_name, team_ip, time, status, server_response])
+USERNAME, EXPLOIT_NAME, TEAM_IP, TIME, STATUS, RESPONSE = range(6)
+SORT_KEYS = {
+    'time': lambda values: values[TIME],
+    'username': lambda values: values[USERNAME],
+    'exploit_name': lambda values: values[EXPLOIT_NAME],
+    'team_ip': lambda values: values[TEAM_IP],
+    'status': lambda values: values[STATUS],
+    'response': lambda values: values[RESPONSE] or '',
+}
+
+
+def matches(values, filters):
+    for k, v in filters.items():
+        if k == 'since':
+            if values[TIME] < v:
+                return False
+        elif k == 'until':
+            if values[TIME] > v:
+                return False
+        elif values[{'username': USERNAME, 'exploit_name': EXPLOIT_NAME, 'team_ip': TEAM_IP,
+                     'status': STATUS, 'server_response': RESPONSE}[k]] != v:
+            return False
+    return True
+
+
+class MemoryStorage(Storage):
+    """The flags in the memory of the web process: no setup and no I/O, but they are gone when it exits.
+
+    Meant for short CTFs and benchmarks. Other processes can't see them, so the submission loop has to run
+    in the web server (SUBMITTER = 'thread'), and so does a single web worker.
+    """
+
+    shared = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._lock = threading.Lock()
+        self._flags = {}  # flag -> [username, exploit_name, team_ip, time, status, server_response]
+        self._inserted = []  # flags, in insertion order
+        self._pending = {}  # flag -> time, of the flags never submitted that have no response yet
+        self._by_minute = defaultdict(list)  # Unix time / 60 -> flags
+        self._counters = Counter()  # (minute, exploit_name, team_ip, status, server_response) -> count
+        self._dimensions = {'username': set(), 'exploit_name': set(), 'team_ip': set()}
+
+    def _update(self, flag, status, response):
+        values = self._flags[flag]
+        minute = values[TIME] // 60
+        self._counters[minute, values[EXPLOIT_NAME], values[TEAM_IP], values[STATUS], values[RESPONSE]] -= 1
+        values[STATUS], values[RESPONSE] = status, response
+        self._counters[minute, values[EXPLOIT_NAME], values[TEAM_IP], status, response] += 1
+        self._pending.pop(flag, None)
+
+    def insert_batch(self, uploads):
+        not_submitted = current_app.config['DB_NSUB']
+        inserted = []
+        with self._lock:
+            for rows in uploads:
+                new_rows = []
+                for row in rows:
+                    flag, username, exploit_name, team_ip, time_, status = row
+                    if flag in self._flags:
+                        continue
+                    self._flags[flag] = [username, exploit_name, team_ip, time_, status, None]
+                    self._inserted.append(flag)
+                    self._by_minute[time_ // 60].append(flag)
+                    self._counters[time_ // 60, exploit_name, team_ip, status, None] += 1
+                    if status == not_submitted:
+                        self._pending[flag] = time_
+                    for kind, value in (('username', username), ('exploit_name', exploit_name), ('team_ip', team_ip)):
+                        self._dimensions[kind].add(value)
+                    new_rows.append(row)
+                inserted.append(new_rows)
+        return inserted
+
+    def _queued(self, flag):
+        values = self._flags[flag]
+        return flag, values[TIME], values[EXPLOIT_NAME], values[TEAM_IP]
+
+    def submittable(self, since):
+        with self._lock:
+            return [self._queued(flag) for flag, time_ in sorted(self._pending.items(), key=lambda item: item[1])
+                    if time_ > since]
+
+    def new_flags(self, after):
+        with self._lock:
+            if after is None:
+                return len(self._inserted), []
+            return len(self._inserted), [self._queued(flag) for flag in self._inserted[after:]
+                                         if flag in self._pending]
+
+    def write_results(self, results):
+        submitted = current_app.config['DB_SUB']
+        with self._lock:
+            for flag, response in results:
+                if flag in self._flags:
+                    self._update(flag, submitted, response)
+
+    def expire(self, since, until, flags=()):
+        expired = current_app.config['DB_EXP']
+        with self._lock:
+            for flag in [flag for flag, time_ in self._pending.items() if since < time_ <= until] + list(flags):
+                if flag in self._pending:
+                    self._update(flag, self._flags[flag][STATUS], expired)
+
+    def chart_data(self, since, expiration, exploit_filter):
+        succ, err, exp = (current_app.config[k] for k in ('DB_SUCC', 'DB_ERR', 'DB_EXP'))
+        nsub = current_app.config['DB_NSUB']
+        expiration_minute = expiration // 60
+        doughnut = {'accepted': 0, 'error': 0, 'queued': 0, 'expired': 0}
+        exploits = {}  # exploit_name -> [first minute, accepted, error], like the teams without the minute
+        teams = {}
+
+        def add(minute, exploit_name, team_ip, status, response, count):
+            doughnut['accepted'] += count * (response == succ)
+            doughnut['error'] += count * (response == err)
+            doughnut['queued'] += count * (status == nsub and response is None and minute >= expiration_minute)
+            doughnut['expired'] += count * (response == exp or status == nsub and response is None
+                                             and minute < expiration_minute)
+            exploit = exploits.setdefault(exploit_name, [minute, 0, 0])
+            exploit[0] = min(exploit[0], minute)
+            exploit[1] += count * (response == succ)
+            exploit[2] += count * (response == err)
+            if not exploit_filter or exploit_name == exploit_filter:
+                team = teams.setdefault(team_ip, [0, 0])
+                team[0] += count * (response == succ)
+                team[1] += count * (response == err)
+
+        with self._lock:
+            # Whole minutes from the counters, the first (partial) one from the flags
+            first_minute = since // 60 if since is not None else -1
+            for key, count in self._counters.items():
+                if key[0] > first_minute and count > 0:
+                    add(*key, count)
+            for flag in self._by_minute.get(first_minute, ()):
+                values = self._flags[flag]
+                if values[TIME] >= since:
+                    add(first_minute, values[EXPLOIT_NAME], values[TEAM_IP], values[STATUS], values[RESPONSE], 1)
+
+        return {
+            'doughnutStatus': doughnut,
+            'barsExploit': [{'name': name, 'accepted': accepted, 'error': error} for name, (_, accepted, error)
+                            in sorted(exploits.items(), key=lambda item: item[1][0])],
+            'barsTeams': [{'name': name, 'accepted': accepted, 'error': error} for name, (accepted, error)
+                          in sorted(teams.items())],
+        }
+
+    def counters(self, since_minute):
+        counters = Counter()
+        with self._lock:
+            for (minute, exploit_name, team_ip, status, response), count in self._counters.items():
+                if minute >= since_minute:
+                    counters[minute, exploit_name, team_ip, response or status] += count
+        return dict(counters)
+
+    def dimension_values(self):
+        with self._lock:
+            return {kind: sorted(values, reverse=True) for kind, values in self._dimensions.items()}
+
+    def _matching(self, filters):
+        with self._lock:
+            return [(flag, *values) for flag, values in self._flags.items() if matches(values, filters)]
+
+    def explore(self, filters, sort, descending, limit, offset, after):
+        key = SORT_KEYS[sort]
+        rows = [(*row, key(row[1:])) for row in self._matching(filters)]
+        if limit is None:
+            return rows
+        if after is not None:
+            after = tuple(after)
+            rows = [row for row in rows if ((row[7], row[0]) < after if descending else (row[7], row[0]) > after)]
+        rows.sort(key=lambda row: (row[7], row[0]), reverse=descending)
+        return rows[offset:offset + limit]
+
+    def count(self, filters):
+        return len(self._matching(filters)), False
+
+    def export(self, filters):
+        return iter(sorted(self._matching(filters), key=lambda row: (row[4], row[0])))
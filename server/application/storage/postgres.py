@@ -0,0 +1,331 @@
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .. import db
+from .base import Storage, MAX_EXACT_COUNT
+
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+# Same layout as schema.sql (codes for status and server_response, see db.statuses() and db.responses()).
+# No rollup table nor archive: PostgreSQL aggregates the flags table itself.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dimensions
+(
+    id    SERIAL PRIMARY KEY,
+    kind  TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (kind, value)
+);
+
+CREATE TABLE IF NOT EXISTS flags
+(
+    id              BIGSERIAL UNIQUE, -- insertion order, for the standalone submitter
+    flag            TEXT PRIMARY KEY,
+    user_id         INTEGER  NOT NULL REFERENCES dimensions (id),
+    exploit_id      INTEGER  NOT NULL REFERENCES dimensions (id),
+    team_id         INTEGER  NOT NULL REFERENCES dimensions (id),
+    time            BIGINT   NOT NULL,
+    status          SMALLINT NOT NULL DEFAULT 0,
+    server_response SMALLINT
+);
+
+CREATE INDEX IF NOT EXISTS idx_time_flag ON flags (time, flag);
+CREATE INDEX IF NOT EXISTS idx_pending ON flags (status, server_response, time);
+'''
+
+INSERT_FLAG = ('INSERT INTO flags (flag, user_id, exploit_id, team_id, time, status) '
+               'VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (flag) DO NOTHING')
+DIMENSIONS = {'username': 1, 'exploit_name': 2, 'team_ip': 3}
+
+
+def dimension_filter(kind):
+    return f"= (SELECT id FROM dimensions WHERE kind = '{kind}' AND value = %s)"
+
+
+def code_param(to_code):
+    def param(value):
+        try:
+            return to_code(value)
+        except ValueError:
+            return -1  # matches nothing
+    return param
+
+
+EXPLORER_FILTERS = {
+    'exploit_name': ('f.exploit_id ' + dimension_filter('exploit_name'), str),
+    'username': ('f.user_id ' + dimension_filter('username'), str),
+    'team_ip': ('f.team_id ' + dimension_filter('team_ip'), str),
+    'status': ('f.status = %s', code_param(lambda value: db.status_code(value))),
+    'server_response': ('f.server_response = %s', code_param(lambda value: db.response_code(value))),
+    'since': ('f.time >= %s', int),
+    'until': ('f.time <= %s', int),
+}
+EXPLORER_SORTS = {
+    'time': 'f.time',
+    'username': 'u.value',
+    'exploit_name': 'e.value',
+    'team_ip': 't.value',
+    'status': 'f.status',
+    'response': 'COALESCE(f.server_response, 0)',
+}
+FLAG_SELECT = '''
+    SELECT f.flag, u.value, e.value, t.value, f.time, f.status, f.server_response
+    FROM flags f
+    JOIN dimensions u ON u.id = f.user_id
+    JOIN dimensions e ON e.id = f.exploit_id
+    JOIN dimensions t ON t.id = f.team_id
+'''
+EXPORT_CHUNK_ROWS = 1000
+
+
+def where_clause(filters):
+    where = []
+    params = []
+    for k, v in filters.items():
+        condition, to_param = EXPLORER_FILTERS[k]
+        where.append(condition)
+        params.append(to_param(v))
+    return (' WHERE ' + ' AND '.join(where)) if where else '', params
+
+
+def named(row):
+    return (*row[:5], db.statuses()[row[5]], db.responses()[row[6]] if row[6] else None, *row[7:])
+
+
+class PostgresStorage(Storage):
+    """The flags in the PostgreSQL database at POSTGRES_DSN (needs psycopg2)."""
+
+    def __init__(self, app):
+        super().__init__(app)
+        if psycopg2 is None:
+            raise RuntimeError("STORAGE = 'postgres' needs psycopg2 (pip install psycopg2-binary)")
+        self.ERRORS = (psycopg2.Error,)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # getconn() raises instead of waiting when all the connections are taken: threads queue up here
+        self._available = threading.BoundedSemaphore(app.config['DB_POOL_SIZE'])
+        self._dimension_ids = {}
+
+    @contextmanager
+    def _connection(self):
+        """A connection of the pool, in a transaction committed at the end of the block."""
+        if self._pool is None:
+            # Created on first use (not at startup, so that the web server can start before PostgreSQL),
+            # once even when the first requests come in together
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(1, current_app.config['DB_POOL_SIZE'],
+                                                                      current_app.config['POSTGRES_DSN'])
+        if not self._available.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']):
+            raise psycopg2.pool.PoolError(f'No PostgreSQL connection free after '
+                                          f"{current_app.config['DB_POOL_TIMEOUT']} seconds")
+        try:
+            connection = self._pool.getconn()
+            try:
+                with connection:
+                    yield connection
+            finally:
+                self._pool.putconn(connection)
+        finally:
+            self._available.release()
+
+    def init(self):
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute(SCHEMA)
+
+    def _dimension_id(self, cur, kind, value, new_ids):
+        key = (kind, value)
+        id_ = self._dimension_ids.get(key) or new_ids.get(key)
+        if id_ is None:
+            cur.execute('INSERT INTO dimensions (kind, value) VALUES (%s, %s) ON CONFLICT (kind, value) DO NOTHING', key)
+            cur.execute('SELECT id FROM dimensions WHERE kind = %s AND value = %s', key)
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f'Invalid {kind} {value!r}')
+            id_ = new_ids[key] = row[0]
+        return id_
+
+    def insert_batch(self, uploads):
+        new_ids = {}
+        inserted = []
+        with self._connection() as connection, connection.cursor() as cur:
+            for rows in uploads:
+                new_rows = []
+                for row in rows:
+                    ids = [self._dimension_id(cur, kind, row[i], new_ids) for kind, i in DIMENSIONS.items()]
+                    cur.execute(INSERT_FLAG, (row[0], *ids, row[4], db.status_code(row[5])))
+                    if cur.rowcount:
+                        new_rows.append(row)
+                inserted.append(new_rows)
+        self._dimension_ids.update(new_ids)
+        return inserted
+
+    def _pending(self, condition, params, order):
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute(f'''
+                SELECT f.id, f.flag, f.time, e.value, t.value
+                FROM flags f
+                JOIN dimensions e ON e.id = f.exploit_id
+                JOIN dimensions t ON t.id = f.team_id
+                WHERE {condition} AND f.status = %s AND f.server_response IS NULL
+                ORDER BY {order}
+                ''', (*params, db.status_code(current_app.config['DB_NSUB'])))
+            return cur.fetchall()
+
+    def submittable(self, since):
+        return [row[1:] for row in self._pending('f.time > %s', (since,), 'f.time')]
+
+    def new_flags(self, after):
+        if after is None:
+            with self._connection() as connection, connection.cursor() as cur:
+                cur.execute('SELECT COALESCE(MAX(id), 0) FROM flags')
+                return cur.fetchone()[0], []
+        rows = self._pending('f.id > %s', (after,), 'f.id')
+        return (rows[-1][0] if rows else after), [row[1:] for row in rows]
+
+    def write_results(self, results):
+        submitted = db.status_code(current_app.config['DB_SUB'])
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.executemany('UPDATE flags SET status = %s, server_response = %s WHERE flag = %s',
+                            [(submitted, db.response_code(response), flag) for flag, response in results])
+
+    def expire(self, since, until, flags=()):
+        expired = db.response_code(current_app.config['DB_EXP'])
+        not_submitted = db.status_code(current_app.config['DB_NSUB'])
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute('''
+                UPDATE flags SET server_response = %s
+                WHERE status = %s AND server_response IS NULL AND time > %s AND time <= %s
+                ''', (expired, not_submitted, since, until))
+            cur.executemany('''
+                UPDATE flags SET server_response = %s
+                WHERE flag = %s AND status = %s AND server_response IS NULL
+                ''', [(expired, flag, not_submitted) for flag in flags])
+
+    def chart_data(self, since, expiration, exploit_filter):
+        params = {
+            'time': since or 0,
+            'expiration': expiration // 60 * 60,  # whole minutes, like the other engines
+            'exploit': exploit_filter,
+            'succ': db.response_code(current_app.config['DB_SUCC']),
+            'err': db.response_code(current_app.config['DB_ERR']),
+            'exp': db.response_code(current_app.config['DB_EXP']),
+            'nsub': db.status_code(current_app.config['DB_NSUB']),
+        }
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute('''
+                SELECT
+                    COUNT(*) FILTER (WHERE server_response = %(succ)s),
+                    COUNT(*) FILTER (WHERE server_response = %(err)s),
+                    COUNT(*) FILTER (WHERE status = %(nsub)s AND server_response IS NULL AND time >= %(expiration)s),
+                    COUNT(*) FILTER (WHERE server_response = %(exp)s
+                                     OR status = %(nsub)s AND server_response IS NULL AND time < %(expiration)s)
+                FROM flags
+                WHERE time >= %(time)s
+                ''', params)
+            doughnut_row = cur.fetchone()
+            cur.execute('''
+                SELECT e.value, COUNT(*) FILTER (WHERE server_response = %(succ)s),
+                       COUNT(*) FILTER (WHERE server_response = %(err)s)
+                FROM flags f
+                JOIN dimensions e ON e.id = f.exploit_id
+                WHERE time >= %(time)s
+                GROUP BY e.value
+                ORDER BY MIN(time / 60)
+                ''', params)
+            barsExploit_rows = cur.fetchall()
+            exploit_filter_query = "AND e.value = %(exploit)s" if exploit_filter else ""
+            cur.execute(f'''
+                SELECT t.value, COUNT(*) FILTER (WHERE server_response = %(succ)s),
+                       COUNT(*) FILTER (WHERE server_response = %(err)s)
+                FROM flags f
+                JOIN dimensions e ON e.id = f.exploit_id
+                JOIN dimensions t ON t.id = f.team_id
+                WHERE time >= %(time)s {exploit_filter_query}
+                GROUP BY t.value
+                ORDER BY t.value
+                ''', params)
+            barsTeams_rows = cur.fetchall()
+
+        return {
+            'doughnutStatus': dict(zip(('accepted', 'error', 'queued', 'expired'), doughnut_row)),
+            'barsExploit': [{'name': row[0], 'accepted': row[1], 'error': row[2]} for row in barsExploit_rows],
+            'barsTeams': [{'name': row[0], 'accepted': row[1], 'error': row[2]} for row in barsTeams_rows],
+        }
+
+    def counters(self, since_minute):
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute('''
+                SELECT f.time / 60, e.value, t.value, f.status, COALESCE(f.server_response, 0), COUNT(*)
+                FROM flags f
+                JOIN dimensions e ON e.id = f.exploit_id
+                JOIN dimensions t ON t.id = f.team_id
+                WHERE f.time >= %s
+                GROUP BY 1, 2, 3, 4, 5
+                ''', (since_minute * 60,))
+            rows = cur.fetchall()
+        counters = {}
+        for minute, exploit_name, team_ip, status, response, count in rows:
+            key = (minute, exploit_name, team_ip, db.outcome_name(status, response))
+            counters[key] = counters.get(key, 0) + count
+        return counters
+
+    def dimension_values(self):
+        values = {kind: [] for kind in DIMENSIONS}
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute('SELECT kind, value FROM dimensions ORDER BY kind, value DESC')
+            for kind, value in cur:
+                values[kind].append(value)
+        return values
+
+    def explore(self, filters, sort, descending, limit, offset, after):
+        where, params = where_clause(filters)
+        with self._connection() as connection, connection.cursor() as cur:
+            if limit is None:
+                cur.execute(f'{FLAG_SELECT} {where}', params)
+                return [(*named(row), None) for row in cur.fetchall()]
+            sort = EXPLORER_SORTS[sort]
+            order = 'DESC' if descending else 'ASC'
+            if after is not None:
+                where += ' AND ' if where else ' WHERE '
+                where += f'({sort}, f.flag) {"<" if descending else ">"} (%s, %s)'
+                params += list(after)
+            cur.execute(f'''
+                {FLAG_SELECT.replace('f.server_response', f'f.server_response, {sort}', 1)} {where}
+                ORDER BY {sort} {order}, f.flag {order}
+                LIMIT %s OFFSET %s
+                ''', params + [limit, offset])
+            return [named(row) for row in cur.fetchall()]
+
+    def count(self, filters):
+        where, params = where_clause(filters)
+        with self._connection() as connection, connection.cursor() as cur:
+            cur.execute(f'SELECT COUNT(*) FROM (SELECT 1 FROM flags f {where} LIMIT {MAX_EXACT_COUNT}) AS matching',
+                        params)
+            count = cur.fetchone()[0]
+        return count, count >= MAX_EXACT_COUNT
+
+    def export(self, filters):
+        # A chunk per query, each with a connection of its own: the response is streamed for as long as
+        # the client takes to read it, the connection is not held meanwhile
+        where, params = where_clause(filters)
+        after = None
+        while True:
+            page_where, page_params = where, list(params)
+            if after is not None:
+                page_where += (' AND ' if where else ' WHERE ') + '(f.time, f.flag) > (%s, %s)'
+                page_params += after
+            with self._connection() as connection, connection.cursor() as cur:
+                cur.execute(f'{FLAG_SELECT} {page_where} ORDER BY f.time, f.flag LIMIT %s',
+                            page_params + [EXPORT_CHUNK_ROWS])
+                rows = cur.fetchall()
+            yield from (named(row) for row in rows)
+            if len(rows) < EXPORT_CHUNK_ROWS:
+                return
+            after = [rows[-1][4], rows[-1][0]]
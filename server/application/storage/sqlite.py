@@ -0,0 +1,352 @@
+import sqlite3
+
+from flask import current_app
+
+from .. import db
+from .base import Storage, archive_time, MAX_EXACT_COUNT
+
+INSERT_FLAG = ('INSERT OR IGNORE INTO flags (flag, user_id, exploit_id, team_id, time, status) '
+               'VALUES (?, ?, ?, ?, ?, ?)')
+INSERT_DIMENSION = 'INSERT OR IGNORE INTO dimensions (kind, value) VALUES (?, ?)'
+ARCHIVED_FLAG = 'SELECT 1 FROM flags_archive WHERE flag = ?'
+ARCHIVE_FLAG = '''
+    INSERT INTO flags_archive (flag, user_id, exploit_id, team_id, time, status, server_response)
+    SELECT flag, user_id, exploit_id, team_id, time, status, server_response FROM flags WHERE rowid = ?
+'''
+# Dimension kind -> position in the flag rows, in the order of the id columns of INSERT_FLAG
+DIMENSIONS = {'username': 1, 'exploit_name': 2, 'team_ip': 3}
+
+# Flags per minute, exploit, team, status and response (0 if there is none) since :time (everything if it's 0).
+# Whole minutes are read from the rollup table, the first (partial) minute from the flags themselves (hot or archived):
+# either way the cost doesn't depend on the size of the flags table.
+CHART_COUNTS = '''
+    WITH counts (minute, exploit_id, team_id, status, response, count) AS (
+        SELECT minute, exploit_id, team_id, status, response, count
+        FROM flags_rollup
+        WHERE minute > :minute AND count > 0
+        UNION ALL
+        SELECT time / 60, exploit_id, team_id, status, IFNULL(server_response, 0), 1
+        FROM flags
+        WHERE time >= :time AND time < :next_minute
+        UNION ALL
+        SELECT time / 60, exploit_id, team_id, status, server_response, 1
+        FROM flags_archive
+        WHERE time >= :time AND time < :next_minute
+    )
+'''
+
+
+def dimension_filter(kind):
+    return f"= (SELECT id FROM dimensions WHERE kind = '{kind}' AND value = ?)"
+
+
+def status_param(value):
+    try:
+        return db.status_code(value)
+    except ValueError:
+        return -1  # matches nothing
+
+
+def response_param(value):
+    try:
+        return db.response_code(value)
+    except ValueError:
+        return -1
+
+
+# Explorer filters: field -> (condition, value -> parameter)
+EXPLORER_FILTERS = {
+    'exploit_name': ('f.exploit_id ' + dimension_filter('exploit_name'), str),
+    'username': ('f.user_id ' + dimension_filter('username'), str),
+    'team_ip': ('f.team_id ' + dimension_filter('team_ip'), str),
+    'status': ('f.status = ?', status_param),
+    'server_response': ('f.server_response = ?', response_param),
+    'since': ('f.time >= ?', int),
+    'until': ('f.time <= ?', int),
+}
+# Filters that the rollup table can count, with the minute instead of the time
+ROLLUP_FILTERS = {
+    'exploit_name': ('exploit_id ' + dimension_filter('exploit_name'), str),
+    'team_ip': ('team_id ' + dimension_filter('team_ip'), str),
+    'since': ('minute >= ? / 60', int),
+    'until': ('minute <= ? / 60', int),
+}
+# Sortable fields -> expression (never NULL, so that it can be compared in the keyset)
+EXPLORER_SORTS = {
+    'time': 'f.time',
+    'username': 'u.value',
+    'exploit_name': 'e.value',
+    'team_ip': 't.value',
+    'status': 'f.status',
+    'response': 'IFNULL(f.server_response, 0)',
+}
+# Flags with the names of their user, exploit and team
+FLAG_COLUMNS = 'f.flag, u.value, e.value, t.value, f.time, f.status, f.server_response'
+FLAG_JOINS = '''
+    FROM flags f
+    JOIN dimensions u ON u.id = f.user_id
+    JOIN dimensions e ON e.id = f.exploit_id
+    JOIN dimensions t ON t.id = f.team_id
+'''
+EXPORT_CHUNK_ROWS = 1000
+
+
+def union_archive(query):
+    """The query on the flags table, then on the archive: `UNION ALL` of both, to be run with the parameters twice."""
+    return f'{query} UNION ALL {query.replace("FROM flags f", "FROM flags_archive f")}'
+
+
+def where_clause(filters, conditions=EXPLORER_FILTERS):
+    """WHERE clause and parameters for the filters. Raises KeyError for the ones not in conditions."""
+    where = []
+    params = []
+    for k, v in filters.items():
+        condition, to_param = conditions[k]
+        where.append(condition)
+        params.append(to_param(v))
+    return (' WHERE ' + ' AND '.join(where)) if where else '', params
+
+
+def named(row):
+    """Row of FLAG_COLUMNS (and anything after them) with the names of its status and response."""
+    return (*row[:5], db.statuses()[row[5]], db.responses()[row[6]] if row[6] else None, *row[7:])
+
+
+class SQLiteStorage(Storage):
+    """The flags in the SQLite database DATABASE (see schema.sql and db.py)."""
+
+    ERRORS = (sqlite3.Error,)
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._dimension_ids = None  # (kind, value) -> id, for the ones already in the dimensions table
+
+    def init(self):
+        db.init_db()
+
+    def _dimension_id(self, database, kind, value, new_ids):
+        """Id of a user, exploit or team, added to the dimensions table (in the current transaction) if it's new."""
+        key = (kind, value)
+        id_ = self._dimension_ids.get(key) or new_ids.get(key)
+        if id_ is None:
+            database.execute(INSERT_DIMENSION, key)
+            row = database.execute('SELECT id FROM dimensions WHERE kind = ? AND value = ?', key).fetchone()
+            if row is None:  # INSERT OR IGNORE skipped it, e.g. a NULL value
+                raise ValueError(f'Invalid {kind} {value!r}')
+            id_ = new_ids[key] = row[0]
+        return id_
+
+    def insert_batch(self, uploads):
+        # Only called by the ingest writer, which is the only one to touch _dimension_ids
+        database = db.get_db()
+        if self._dimension_ids is None:
+            self._dimension_ids = {(kind, value): id_ for id_, kind, value in
+                                   database.execute('SELECT id, kind, value FROM dimensions')}
+        new_ids = {}
+        inserted = []
+        # Only flags this old can be in the archive, where the primary key of flags doesn't see them
+        archived_until = archive_time()
+        with database:
+            for rows in uploads:
+                new_rows = []
+                for row in rows:
+                    if row[4] <= archived_until and database.execute(ARCHIVED_FLAG, (row[0],)).fetchone():
+                        continue
+                    ids = [self._dimension_id(database, kind, row[i], new_ids) for kind, i in DIMENSIONS.items()]
+                    if database.execute(INSERT_FLAG, (row[0], *ids, row[4], db.status_code(row[5]))).rowcount:
+                        new_rows.append(row)
+                inserted.append(new_rows)
+        self._dimension_ids.update(new_ids)
+        return inserted
+
+    def submittable(self, since):
+        return db.get_db(readonly=True).execute('''
+            SELECT f.flag, f.time, e.value, t.value
+            FROM flags f
+            JOIN dimensions e ON e.id = f.exploit_id
+            JOIN dimensions t ON t.id = f.team_id
+            WHERE f.time > ? AND f.status = ? AND f.server_response IS NULL
+            ORDER BY f.time
+            ''', (since, db.status_code(current_app.config['DB_NSUB']))).fetchall()
+
+    def new_flags(self, after):
+        # Positions are rowids, which keep growing (see archive())
+        database = db.get_db(readonly=True)
+        if after is None:
+            return database.execute('SELECT IFNULL(MAX(rowid), 0) FROM flags').fetchone()[0], []
+        rows = database.execute('''
+            SELECT f.rowid, f.flag, f.time, e.value, t.value
+            FROM flags f
+            JOIN dimensions e ON e.id = f.exploit_id
+            JOIN dimensions t ON t.id = f.team_id
+            WHERE f.rowid > ? AND f.status = ? AND f.server_response IS NULL
+            ORDER BY f.rowid
+            ''', (after, db.status_code(current_app.config['DB_NSUB']))).fetchall()
+        return (rows[-1][0] if rows else after), [row[1:] for row in rows]
+
+    def write_results(self, results):
+        submitted = db.status_code(current_app.config['DB_SUB'])
+        database = db.get_db()
+        with database:
+            database.executemany('''
+                UPDATE flags
+                SET status = ?, server_response = ?
+                WHERE flag = ?
+                ''', [(submitted, db.response_code(response), flag) for flag, response in results])
+
+    def expire(self, since, until, flags=()):
+        expired = db.response_code(current_app.config['DB_EXP'])
+        not_submitted = db.status_code(current_app.config['DB_NSUB'])
+        database = db.get_db()
+        with database:
+            database.execute('''
+                UPDATE flags
+                SET server_response = ?
+                WHERE status = ? AND server_response IS NULL AND time > ? AND time <= ?
+                ''', (expired, not_submitted, since, until))
+            database.executemany('''
+                UPDATE flags
+                SET server_response = ?
+                WHERE flag = ? AND status = ? AND server_response IS NULL
+                ''', [(expired, flag, not_submitted) for flag in flags])
+
+    def archive(self, until, limit):
+        """Move flags to flags_archive, oldest first. The dashboard counters don't change: the rollup table
+        counts the archived flags too."""
+        database = db.get_db()
+        with database:
+            # The newest row always stays: rowids keep growing, the standalone submitter relies on it to find new flags
+            rowids = database.execute('''
+                SELECT rowid FROM flags
+                WHERE time <= ? AND server_response IS NOT NULL AND rowid < (SELECT MAX(rowid) FROM flags)
+                ORDER BY time
+                LIMIT ?
+                ''', (until, limit)).fetchall()
+            database.executemany(ARCHIVE_FLAG, rowids)
+            database.executemany('DELETE FROM flags WHERE rowid = ?', rowids)
+        return len(rowids)
+
+    def chart_data(self, since, expiration, exploit_filter):
+        params = {
+            'minute': since // 60 if since is not None else -1,
+            'time': since or 0,
+            'next_minute': (since // 60 + 1) * 60 if since is not None else 0,
+            'expiration': expiration // 60,
+            'exploit': exploit_filter,
+            'succ': db.response_code(current_app.config['DB_SUCC']),
+            'err': db.response_code(current_app.config['DB_ERR']),
+            'exp': db.response_code(current_app.config['DB_EXP']),
+            'nsub': db.status_code(current_app.config['DB_NSUB']),
+        }
+        cur = db.get_db(readonly=True).cursor()
+        cur.execute(CHART_COUNTS + '''
+            SELECT
+                SUM(count * (response = :succ)) AS accepted,
+                SUM(count * (response = :err)) AS error,
+                SUM(count * (status = :nsub AND response = 0 AND minute >= :expiration)) AS queued,
+                SUM(count * (response = :exp OR status = :nsub AND response = 0 AND minute < :expiration)) AS expired
+            FROM counts
+            ''', params)
+        doughnut_row = cur.fetchone()
+        cur.execute(CHART_COUNTS + '''
+            SELECT
+               e.value,
+               SUM(count * (response = :succ)) AS accepted,
+               SUM(count * (response = :err)) AS error
+            FROM counts
+            JOIN dimensions e ON e.id = exploit_id
+            GROUP BY exploit_id
+            ORDER BY MIN(minute)
+            ''', params)
+        barsExploit_rows = cur.fetchall()
+        exploit_filter_query = ("WHERE exploit_id = (SELECT id FROM dimensions WHERE kind = 'exploit_name' AND value = :exploit)"
+                                if exploit_filter else "")
+        cur.execute(CHART_COUNTS + f'''
+            SELECT
+               t.value,
+               SUM(count * (response = :succ)) AS accepted,
+               SUM(count * (response = :err)) AS error
+            FROM counts
+            JOIN dimensions t ON t.id = team_id
+            {exploit_filter_query}
+            GROUP BY team_id
+            ORDER BY t.value
+            ''', params)
+        barsTeams_rows = cur.fetchall()
+
+        return {
+            'doughnutStatus': {
+                'accepted': doughnut_row[0],
+                'error': doughnut_row[1],
+                'queued': doughnut_row[2],
+                'expired': doughnut_row[3]
+            },
+            'barsExploit': [{'name': row[0], 'accepted': row[1], 'error': row[2]} for row in barsExploit_rows],
+            'barsTeams': [{'name': row[0], 'accepted': row[1], 'error': row[2]} for row in barsTeams_rows],
+        }
+
+    def counters(self, since_minute):
+        rows = db.get_db(readonly=True).execute('''
+            SELECT r.minute, e.value, t.value, r.status, r.response, r.count
+            FROM flags_rollup r
+            JOIN dimensions e ON e.id = r.exploit_id
+            JOIN dimensions t ON t.id = r.team_id
+            WHERE r.minute >= ?
+            ''', (since_minute,)).fetchall()
+        return {(minute, exploit_name, team_ip, db.outcome_name(status, response)): count
+                for minute, exploit_name, team_ip, status, response, count in rows}
+
+    def dimension_values(self):
+        values = {kind: [] for kind in DIMENSIONS}
+        for kind, value in db.get_db(readonly=True).execute('SELECT kind, value FROM dimensions '
+                                                            'ORDER BY kind, value DESC'):
+            values[kind].append(value)
+        return values
+
+    def explore(self, filters, sort, descending, limit, offset, after):
+        where, params = where_clause(filters)
+        cur = db.get_db(readonly=True).cursor()
+        if limit is None:
+            cur.execute(union_archive(f'SELECT {FLAG_COLUMNS}, NULL {FLAG_JOINS} {where}'), params * 2)
+            return [named(row) for row in cur.fetchall()]
+
+        sort = EXPLORER_SORTS[sort]
+        order = 'DESC' if descending else 'ASC'
+        if after is not None:
+            where += ' AND ' if where else ' WHERE '
+            where += f'({sort}, f.flag) {"<" if descending else ">"} (?, ?)'
+            params += list(after)
+        # The first limit + offset of each table, then the page out of both
+        cur.execute(union_archive(f'''
+            SELECT * FROM (
+                SELECT {FLAG_COLUMNS}, {sort}
+                {FLAG_JOINS} {where}
+                ORDER BY {sort} {order}, f.flag {order}
+                LIMIT ?)
+            ''') + f'ORDER BY 8 {order}, 1 {order} LIMIT ? OFFSET ?', (params + [limit + offset]) * 2 + [limit, offset])
+        return [named(row) for row in cur.fetchall()]
+
+    def count(self, filters):
+        cur = db.get_db(readonly=True).cursor()
+        try:
+            where, params = where_clause(filters, ROLLUP_FILTERS)
+        except KeyError:
+            where, params = where_clause(filters)
+            cur.execute(f'SELECT COUNT(*) FROM ({union_archive(f"SELECT 1 FROM flags f {where}")} '
+                        f'LIMIT {MAX_EXACT_COUNT})', params * 2)
+            count = cur.fetchone()[0]
+            return count, count >= MAX_EXACT_COUNT
+        # The rollup table counts whole minutes
+        cur.execute(f'SELECT IFNULL(SUM(count), 0) FROM flags_rollup {where}', params)
+        return cur.fetchone()[0], 'since' in filters or 'until' in filters
+
+    def export(self, filters):
+        where, params = where_clause(filters)
+        cur = db.get_db(readonly=True).cursor()
+        # Both tables are read in (time, flag) order and merged
+        cur.execute(union_archive(f'SELECT {FLAG_COLUMNS} {FLAG_JOINS} {where}') + ' ORDER BY 5, 1', params * 2)
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                return
+            yield from (named(row) for row in rows)
@@ -0,0 +1,89 @@
+import json
+import queue
+import threading
+import time
+
+from flask import Flask, current_app
+
+from . import storage, submission_loop
+
+
+class ChartStream:
+    """Changes of the dashboard counters, pushed to all the connected dashboards (Server-Sent Events).
+
+    A single thread reads the recent dashboard counters every STREAM_INTERVAL seconds, whatever the
+    number of viewers, and sends each of them the difference with the previous read.
+    Only the minutes where flags can still be waiting for a response are read: changes to older ones (a
+    late expiry sweep, a late response) are not streamed, and show up when the dashboard reloads its
+    charts, which it keeps doing every few seconds (see resetInterval() in index.js).
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self) -> queue.Queue:
+        messages = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.add(messages)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='chart_stream')
+                self._thread.start()
+        return messages
+
+    def unsubscribe(self, messages: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(messages)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, message: str):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for messages in subscribers:
+            try:
+                messages.put_nowait(message)
+            except queue.Full:
+                pass  # too slow to keep up: it will catch up when it reloads the charts
+
+    def _run(self):
+        with self.app.app_context():
+            flags = storage.get_storage()
+            snapshot = None
+            queued = None
+            while True:
+                time.sleep(current_app.config['STREAM_INTERVAL'])
+                if not self._subscribers:
+                    snapshot = queued = None
+                    continue
+
+                # Flags change status until they expire: older minutes only change when the submitter lags
+                now = int(time.time()) // 60
+                since = now - current_app.config['FLAG_ALIVE'] // 60 - 1
+                try:
+                    current = flags.counters(since)
+                    new_queued = submission_loop.loop_stats()['queue'].get('queued')
+                except Exception:
+                    # e.g. the database is locked for a while: the next read sends what changed meanwhile
+                    current_app.logger.exception('stream: could not read the dashboard counters')
+                    continue
+                if snapshot is not None:
+                    changes = []
+                    for key in current.keys() | snapshot.keys():
+                        delta = current.get(key, 0) - snapshot.get(key, 0)
+                        if delta and key[0] >= since:
+                            changes.append([now - key[0], key[1], key[2], key[3], delta])
+                    if changes or new_queued != queued:
+                        self.publish(json.dumps({'changes': changes, 'queued': new_queued}))
+                snapshot, queued = current, new_queued
+
+
+def get_stream() -> ChartStream:
+    return current_app.extensions['chart_stream']
+
+
+def init_app(app):
+    app.extensions['chart_stream'] = ChartStream(app)
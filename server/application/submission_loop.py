@@ -1,15 +1,28 @@
+import asyncio
+import fcntl
 import logging
+import os
+import socket
+import threading
 import time
-from datetime import datetime, timedelta
-from queue import Queue
+import urllib.parse
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
 from typing import List
 
+import click
 import requests
 from flask import Flask, current_app
-from ordered_set import OrderedSet
+from flask.cli import with_appcontext
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
 
-from . import db
+from . import archive, flag_queue, ingest, maintenance, storage
+from .flag_queue import QueuedFlag
 
 
 END				= "\033[0m"
@@ -53,6 +66,30 @@ class CustomFormatter(logging.Formatter):
 
 
 class Submitter:
+	# (SUB_* attribute, outcome), checked in this order: the first marker found in a response decides its outcome
+	OUTCOME_MARKERS = (
+		('SUB_INVALID', 'invalid'),
+		('SUB_YOUR_OWN', 'yours'),
+		('SUB_NOP', 'nop'),
+		('SUB_OLD', 'old'),
+		('SUB_ACCEPTED', 'accepted'),
+		('SUB_STOLEN', 'accepted'),
+	)
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._markers = [(getattr(cls, attr).lower(), outcome) for attr, outcome in cls.OUTCOME_MARKERS
+						if hasattr(cls, attr)]
+
+	@classmethod
+	def classify(cls, msg: str):
+		"""Returns the outcome of a response message (one of OUTCOME_MARKERS'), or None if it's not recognized."""
+		msg = msg.lower()
+		for marker, outcome in cls._markers:
+			if marker in msg:
+				return outcome
+		return None
+
 	def submit_flags(self, flags: List[str]):
 		"""
 		Should return
@@ -64,6 +101,25 @@ class Submitter:
 		"""
 		raise NotImplementedError()
 
+	# Number of requests that can be in flight at the same time
+	concurrency = 1
+
+	def submit_async(self, flags: List[str]) -> Future:
+		"""
+		Starts submitting the flags, returns a Future for the result of submit_flags().
+		Submitters that can send more requests at the same time override it (and concurrency),
+		by default the flags are submitted before returning.
+		"""
+		future = Future()
+		try:
+			future.set_result(self.submit_flags(flags))
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	def close(self):
+		pass
+
 class DummySubmitter(Submitter):
 	SUB_ACCEPTED = 'accepted'
 	SUB_INVALID = 'invalid'
@@ -89,11 +145,14 @@ class CCITSubmitter(Submitter):
 	SUB_NOP = 'from NOP team'
 	SUB_NOT_AVAILABLE = 'is not available'
 
+	def __init__(self):
+		self.session = requests.Session()
+
 	def submit_flags(self, flags):
-		res = requests.put(current_app.config['SUB_URL'],
-							headers={'X-Team-Token': current_app.config['TEAM_TOKEN']},
-							json=flags,
-							timeout=(current_app.config['SUB_INTERVAL'] / current_app.config['SUB_LIMIT']))
+		res = self.session.put(current_app.config['SUB_URL'],
+							   headers={'X-Team-Token': current_app.config['TEAM_TOKEN']},
+							   json=flags,
+							   timeout=(current_app.config['SUB_INTERVAL'] / current_app.config['SUB_LIMIT']))
 
 		# Check if the gameserver sent a response about the flags or if it sent an error
 		if 'application/json' in res.headers['Content-Type']:
@@ -102,13 +161,116 @@ class CCITSubmitter(Submitter):
 			current_app.logger.error(f'Received this response from the gameserver:\n\n{res.text}\n')
 			return []
 
-from pwnlib.tubes.remote import remote
-import urllib.parse
+class CCITAsyncSubmitter(CCITSubmitter):
+	"""
+	Same protocol as CCITSubmitter, on a pool of keep-alive connections driven by asyncio:
+	up to SUB_LIMIT requests can be in flight at the same time, each with a timeout of SUB_INTERVAL seconds.
+	"""
+
+	def __init__(self):
+		if aiohttp is None:
+			raise RuntimeError('the ccit_async submitter needs aiohttp (pip3 install aiohttp)')
+		self.url = current_app.config['SUB_URL']
+		self.logger = current_app.logger
+		self.concurrency = current_app.config['SUB_LIMIT']
+		self.timeout = aiohttp.ClientTimeout(total=current_app.config['SUB_INTERVAL'])
+		self.loop = asyncio.new_event_loop()
+		threading.Thread(target=self.loop.run_forever, daemon=True, name='ccit_async_submitter').start()
+		self.session = asyncio.run_coroutine_threadsafe(
+			self._create_session(current_app.config['TEAM_TOKEN']), self.loop).result()
+
+	async def _create_session(self, token):
+		return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+									 headers={'X-Team-Token': token})
+
+	async def _submit(self, flags):
+		async with self.session.put(self.url, json=flags, timeout=self.timeout) as res:
+			# Check if the gameserver sent a response about the flags or if it sent an error
+			if 'application/json' in res.headers.get('Content-Type', ''):
+				return await res.json()
+			else:
+				self.logger.error(f'Received this response from the gameserver:\n\n{await res.text()}\n')
+				return []
+
+	def submit_async(self, flags):
+		return asyncio.run_coroutine_threadsafe(self._submit(flags), self.loop)
+
+	def submit_flags(self, flags):
+		return self.submit_async(flags).result()
+
+	def close(self):
+		asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+		self.loop.call_soon_threadsafe(self.loop.stop)
+
+class FaustConnection:
+	"""Persistent connection to a ctf-gameserver submission service.
+
+	Flags are pipelined: up to WINDOW flags are sent before waiting for their responses, which are
+	matched back to the flags as they arrive. The connection is reopened when it breaks.
+	"""
+	WINDOW = 128
+
+	def __init__(self, host, port, timeout, logger):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.logger = logger
+		self.sock = None
+		self.buffer = b''
+
+	def connect(self):
+		self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.buffer = b''
+		# The banner ends with an empty line
+		while self.readline().strip() != b'':
+			pass
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+		self.sock = None
+
+	def readline(self):
+		while b'\n' not in self.buffer:
+			data = self.sock.recv(65536)
+			if not data:
+				raise ConnectionError('connection closed by the gameserver')
+			self.buffer += data
+		line, self.buffer = self.buffer.split(b'\n', 1)
+		return line
+
+	def submit(self, flags):
+		res = []
+		pending = list(reversed(flags))
+		outstanding = set()
+		try:
+			if self.sock is None:
+				self.connect()
+			while pending or outstanding:
+				if pending and len(outstanding) < self.WINDOW:
+					chunk = [pending.pop() for _ in range(min(self.WINDOW - len(outstanding), len(pending)))]
+					self.sock.sendall(b''.join(flag.encode() + b'\n' for flag in chunk))
+					outstanding.update(chunk)
+
+				line = self.readline().decode(errors='replace').split()
+				if len(line) < 2 or line[0] not in outstanding:
+					self.logger.warning(f'submitter: skipping response line {line}')
+					continue
+				outstanding.discard(line[0])
+				res.append({'flag': line[0], 'msg': line[1]})
+		except OSError as e:
+			# Flags without a response are put back in the queue by the loop
+			self.logger.warning(f'submitter: {self.host}:{self.port}: {e} ({len(pending) + len(outstanding)} flags unanswered)')
+			self.close()
+		return res
+
 
 class FaustSubmitter(Submitter):
 	"""
 	https://ctf-gameserver.org/submission/
 	SUB_URL should be of this format: tcp://submission.faustctf.net:666/
+	Flags are split between SUB_CONNECTIONS persistent connections.
 	"""
 	SUB_ACCEPTED = 'OK'
 	SUB_INVALID = 'INV'
@@ -123,60 +285,182 @@ class FaustSubmitter(Submitter):
 		self.host = url.hostname
 		self.port = url.port
 		current_app.logger.info(f'{self.host}, {self.port}')
+		timeout = current_app.config['SUB_INTERVAL'] / current_app.config['SUB_LIMIT']
+		self.connections = [FaustConnection(self.host, self.port, timeout, current_app.logger)
+							for _ in range(current_app.config['SUB_CONNECTIONS'])]
+		self.executor = ThreadPoolExecutor(len(self.connections), thread_name_prefix='faust_submitter')
 
 	def submit_flags(self, flags):
-		flags = set(flags)
+		flags = list(dict.fromkeys(flags))
+		if len(self.connections) == 1:
+			return self.connections[0].submit(flags)
 
-		try:
-			s = remote(self.host, self.port, timeout=current_app.config['SUB_INTERVAL'] / current_app.config['SUB_LIMIT'])
-			line = s.recvline()
-			while line.strip() != b'':
-				line = s.recvline()
-
-			res = []
-			for flag in flags:
-				s.sendline(flag.encode())
-				line = s.recvline().decode()
-
-				line = line.split()
-				if len(line) < 1 or line[0] not in flags:
-					print('submitter: skipping response line', line)
-					continue
-
-				res.append({'flag':line[0], 'msg':line[1]})
-				print(res)
-
-			return res
-
-		except Exception as e:
-			print(e)
-			return []
+		n = len(self.connections)
+		results = self.executor.map(lambda i: self.connections[i].submit(flags[i::n]), range(n))
+		return [item for res in results for item in res]
 
 submitters = {
 	'dummy': DummySubmitter,
 	'ccit': CCITSubmitter,
+	'ccit_async': CCITAsyncSubmitter,
 	'faust': FaustSubmitter
 }
 
+# Errors that mean the flags didn't reach the gameserver (requests' exceptions are OSErrors too)
+NETWORK_ERRORS = (OSError, asyncio.TimeoutError) + ((aiohttp.ClientError,) if aiohttp is not None else ())
 
-class OrderedSetQueue(Queue):
-	"""Unique queue.
 
-	Elements cannot be repeated, so there's no need to traverse it to check.
-	LIFO ordered and thread-safe.
+class TokenBucket:
+	"""Adaptive rate limiter for the requests sent to the gameserver.
+
+	Tokens are refilled continuously at `rate` per second (at most `burst` can be saved up), so requests
+	are spread evenly over SUB_INTERVAL instead of being sent all at once. The rate is halved when the
+	gameserver answers RATE_LIMIT, reduced when it gets slow, and grows back after every quick response,
+	up to `max_rate`.
 	"""
 
-	def _init(self, maxsize):
-		self.queue = OrderedSet()
+	def __init__(self, max_rate: float, burst: int = 1, concurrency: int = 1):
+		self.max_rate = max_rate
+		self.concurrency = concurrency
+		self.min_rate = max_rate / 16
+		self.rate = max_rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def wait_time(self) -> float:
+		"""Seconds until a token is available."""
+		self._refill()
+		return max(0.0, (1 - self.tokens) / self.rate)
+
+	def consume(self):
+		self._refill()
+		self.tokens -= 1
+
+	def on_rate_limit(self):
+		self.rate = max(self.min_rate, self.rate / 2)
+		self.tokens = min(self.tokens, 0)
+
+	def on_response(self, latency: float):
+		# A response slower than the time between two requests (times the requests that can be in flight)
+		# means the gameserver is struggling
+		if latency > self.concurrency / self.rate:
+			self.rate = max(self.min_rate, self.rate * 0.8)
+		else:
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 8)
+
 
-	def _put(self, item):
-		self.queue.add(item)
+# Database response for each submission outcome
+OUTCOME_RESPONSES = {
+	'accepted': 'DB_SUCC',
+	'old': 'DB_EXP',
+	'invalid': 'DB_ERR',
+	'yours': 'DB_ERR',
+	'nop': 'DB_ERR',
+}
 
-	def _get(self):
-		return self.queue.pop()
 
+def write_results(flags, submitter: Submitter, submit_result):
+	"""Classify the gameserver responses and store them in one transaction.
 
-def loop(app: Flask):
+	Returns {outcome: [items]}, with the items that couldn't be classified under 'unknown'.
+	"""
+	outcomes = defaultdict(list)
+	updates = []
+	for item in submit_result:
+		outcome = submitter.classify(item['msg'])
+		if outcome is None:
+			outcomes['unknown'].append(item)
+			continue
+		outcomes[outcome].append(item)
+		updates.append((item['flag'], current_app.config[OUTCOME_RESPONSES[outcome]]))
+
+	flags.write_results(updates)
+	return outcomes
+
+
+def expire_flags(flags, since: int, until: int, expired=()):
+	"""Mark as EXPIRED the flags never submitted with since < time <= until.
+
+	`expired` items are marked as well, whatever their time: they expired while in the queue, maybe because
+	they were already too old when they arrived, after the sweep that covered their time.
+	"""
+	flags.expire(since, until, [item.flag for item in expired])
+
+
+def get_stats() -> Counter:
+	"""Number of submitted batches and of flags per outcome, since startup."""
+	return current_app.extensions['submission_stats']
+
+
+def expiration_time() -> int:
+	return int(time.time()) - current_app.config['FLAG_ALIVE']
+
+
+def acquire_lock(app: Flask):
+	"""Lock held by the running submission loop, across processes. Returns None if another loop holds it.
+
+	The returned file must be kept open: closing it (or exiting) releases the lock.
+	"""
+	lock = open(os.path.join(app.instance_path, 'submitter.lock'), 'w')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		lock.close()
+		return None
+	return lock
+
+
+def stats_path(app: Flask):
+	return os.path.join(app.instance_path, 'submitter_stats.json')
+
+
+def loop_stats():
+	"""Counters of the submission loop, of its queue and of the database maintenance (which runs with it),
+	read from the worker process when it runs on its own."""
+	if current_app.config['SUBMITTER'] == 'process':
+		try:
+			with open(stats_path(current_app)) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {'submission': {}, 'queue': {}, 'maintenance': {}}
+	return {'submission': dict(get_stats()), 'queue': flag_queue.get_queue().stats(),
+			'maintenance': maintenance.get_maintenance().stats()}
+
+
+def write_loop_stats(app: Flask, queue):
+	path = stats_path(app)
+	with open(path + '.tmp', 'w') as f:
+		json.dump({'submission': dict(get_stats()), 'queue': queue.stats(),
+				   'maintenance': maintenance.get_maintenance().stats()}, f)
+	os.replace(path + '.tmp', path)
+
+
+def poll_flags(app: Flask, queue, position):
+	"""Feeds the queue with the flags stored after `position` (see Storage.new_flags()), by any process.
+
+	Used by the standalone worker, which doesn't see the uploads handled by the web processes.
+	"""
+	with app.app_context():
+		flags = storage.get_storage()
+		while True:
+			time.sleep(current_app.config['SUB_POLL_INTERVAL'])
+			position, rows = flags.new_flags(position)
+			if rows:
+				queue.put_many(QueuedFlag(*row) for row in rows)
+
+
+def loop(app: Flask, standalone=False):
+	"""Submit the queued flags until the process exits.
+
+	In the web process (standalone=False) new flags are pushed by the ingest writer; the standalone worker
+	started by `flask submitter` polls the database for them instead.
+	"""
 	with app.app_context():
 		logger = current_app.logger  # Need to get it before sleep, otherwise it doesn't work. Don't know why.
 
@@ -189,113 +473,153 @@ def loop(app: Flask):
 		if current_app.config["SUB_PROTOCOL"] not in submitters.keys():
 			logger.error(f"Invalid SUB_PROTOCOL {current_app.config['SUB_PROTOCOL']}. Valid values are {list(submitters.keys())}")
 			return
+
+		# Only one submission loop at a time, whatever the number of processes
+		lock = acquire_lock(app)
+		if lock is None:
+			logger.warning(f'{YELLOW}another submission loop is already running, not starting.{END}')
+			if not standalone:
+				# The running loop is only fed by the ingest writer of its own process
+				logger.error(f"{RED}the flags uploaded to this worker won't be submitted until the submission loop "
+							 f"restarts: use SUBMITTER = 'process' with more than one web worker.{END}")
+			return
 		submitter = submitters[current_app.config["SUB_PROTOCOL"]]()
 
 		# Let's not make it start right away
 		time.sleep(5)
 		logger.info(f'{GREEN}starting.{END}')
-		database = db.get_db()
-		queue = OrderedSetQueue()
-		while True:
-			s_time = time.time()
-			expiration_time = (datetime.now() - timedelta(seconds=current_app.config['FLAG_ALIVE'])).replace(microsecond=0).isoformat(sep=' ')
-			cursor = database.cursor()
-			cursor.execute('''
-			SELECT flag
-			FROM flags
-			WHERE time > ? AND status = ? AND server_response IS NULL
-			ORDER BY time DESC
-			''', (expiration_time, current_app.config['DB_NSUB']))
-			for flag in cursor.fetchall():
-				queue.put(flag[0])
-			i = 0
-			queue_length = queue.qsize()
+		flags_storage = storage.get_storage()
+
+		# New flags are pushed by the ingest writer (or polled, in the standalone worker),
+		# the storage is only read in full once to rebuild the queue
+		queue = flag_queue.get_queue()
+		if standalone:
+			position, _ = flags_storage.new_flags(None)
+			threading.Thread(target=poll_flags, daemon=True, name='submission_poller',
+							 args=(app, queue, position)).start()
+		else:
+			ingest.get_writer().subscribe(
+				lambda rows: queue.put_many(QueuedFlag(row[0], row[4], row[2], row[3]) for row in rows))
+		queue.put_many(QueuedFlag(*row) for row in flags_storage.submittable(expiration_time()))
+		logger.info(f'{len(queue)} flags queued.')
+
+		stats = get_stats()
+		if current_app.config['STORAGE'] == 'sqlite':
+			maintenance.get_maintenance().start()
+		if current_app.config['ARCHIVE_AFTER_ROUNDS']:
+			threading.Thread(target=archive.run, daemon=True, name='archiver', args=(app, stats)).start()
+		bucket = TokenBucket(current_app.config['SUB_LIMIT'] / current_app.config['SUB_INTERVAL'],
+							 current_app.config['SUB_BURST'], submitter.concurrency)
+
+		def handle_result(flags, future, latency):
+			# Flags that don't get a response are put back in the queue
+			flags_by_name = {item.flag: item for item in flags}
+			unanswered = dict(flags_by_name)
 			try:
-				# Send N requests per interval
-				while i < min(current_app.config['SUB_LIMIT'], queue_length):
-					# Send N flags per request
-					flags = []
-					for _ in range(min(current_app.config['SUB_PAYLOAD_SIZE'], queue_length)):
-						flags.append(queue.get())
-
-					submit_result = submitter.submit_flags(flags)
-
-					if type(submit_result) == dict:
-						# {'code': 'RATE_LIMIT', 'message': '[RATE_LIMIT] Rate limit exceeded'}
-						if submit_result.get('code', '') == 'RATE_LIMIT':
-							msg = submit_result.get('message', '')
-							if msg:
-								logger.warning(f'{msg}')
-							else:
-								logger.error(f'Submit result: {submit_result}')
+				submit_result = future.result()
+
+				if type(submit_result) == dict:
+					# {'code': 'RATE_LIMIT', 'message': '[RATE_LIMIT] Rate limit exceeded'}
+					if submit_result.get('code', '') == 'RATE_LIMIT':
+						bucket.on_rate_limit()
+						msg = submit_result.get('message', '')
+						if msg:
+							logger.warning(f'{msg} (slowing down to {bucket.rate * current_app.config["SUB_INTERVAL"]:.2f} requests per interval)')
 						else:
 							logger.error(f'Submit result: {submit_result}')
-						time.sleep(current_app.config['SUB_INTERVAL'])
-						break
-
-					# executemany() would be better, but it's fine like this.
-					accepted = 0
-					old = 0
-					nop = 0
-					yours = 0
-					invalid = 0
-					update_flag = '''
-					UPDATE flags
-					SET status = ?, server_response = ?
-					WHERE flag = ?
-					'''
-
-					if len(submit_result) == 0: break
-
-					for item in submit_result:
-						if submitter.SUB_INVALID.lower() in item['msg'].lower():
-							cursor.execute(update_flag, (current_app.config['DB_SUB'], current_app.config['DB_ERR'], item['flag']))
-							invalid += 1
-						elif submitter.SUB_YOUR_OWN.lower() in item['msg'].lower():
-							cursor.execute(update_flag, (current_app.config['DB_SUB'], current_app.config['DB_ERR'], item['flag']))
-							yours += 1
-						elif submitter.SUB_NOP.lower() in item['msg'].lower():
-							cursor.execute(update_flag, (current_app.config['DB_SUB'], current_app.config['DB_ERR'], item['flag']))
-							nop += 1
-						elif submitter.SUB_OLD.lower() in item['msg'].lower():
-							cursor.execute(update_flag, (current_app.config['DB_SUB'], current_app.config['DB_EXP'], item['flag']))
-							old += 1
-						elif (submitter.SUB_ACCEPTED.lower() in item['msg'].lower() or
-								submitter.SUB_STOLEN.lower() in item['msg'].lower()):
-							cursor.execute(update_flag, (current_app.config['DB_SUB'], current_app.config['DB_SUCC'], item['flag']))
-							accepted += 1
-						else:
-							logger.error(f'{item}')
-						i += 1
-
-					msg = f'Submitted {GREEN}{len(flags)}{END} flags: {GREEN}{accepted} Accepted{END}'
-					if old:
-						msg += f' {CYAN}{old} Old{END}'
-					if nop:
-						msg += f' {HIGH_PURPLE}{nop} NOP{END}'
-					if yours:
-						msg += f' {HIGH_YELLOW}{yours} Yours{END}'
-					if invalid:
-						# logger.warning(f'{submit_result}')
-						msg += f' {RED}{invalid} Invalid{END}'
-					logger.info(msg)
-
-
-			except requests.exceptions.RequestException as e:
+					else:
+						logger.error(f'Submit result: {submit_result}')
+					return
+
+				bucket.on_response(latency)
+				if len(submit_result) == 0:
+					return
+
+				outcomes = write_results(flags_storage, submitter, submit_result)
+				counts = {outcome: len(items) for outcome, items in outcomes.items()}
+				stats.update(counts)
+				stats['batches'] += 1
+				for item in submit_result:
+					unanswered.pop(item['flag'], None)
+				for item in outcomes.get('unknown', []):
+					logger.error(f'{item}')
+					if item['flag'] in flags_by_name:
+						unanswered[item['flag']] = flags_by_name[item['flag']]
+
+				msg = f'Submitted {GREEN}{len(flags)}{END} flags: {GREEN}{counts.get("accepted", 0)} Accepted{END}'
+				for outcome, color, label in (('old', CYAN, 'Old'), ('nop', HIGH_PURPLE, 'NOP'),
+											  ('yours', HIGH_YELLOW, 'Yours'), ('invalid', RED, 'Invalid')):
+					if counts.get(outcome):
+						msg += f' {color}{counts[outcome]} {label}{END}'
+				logger.info(msg)
+
+			except NETWORK_ERRORS as e:
 				logger.warning('Could not send the flags to the server, retrying...')
-				logger.warning(f'{e}')
+				logger.warning(f'{e!r}')
 			except Exception as e:
 				logger.critical(f'{e}')
 				time.sleep(current_app.config['SUB_INTERVAL'])
 
 			finally:
-				# At the end, update status as EXPIRED for flags not sent because too old
-				cursor.execute('''
-									UPDATE flags
-									SET server_response = ?
-									WHERE status LIKE 'NOT_SUBMITTED' AND time <= ?
-									''', (current_app.config['DB_EXP'], expiration_time))
-				database.commit()
-				duration = time.time() - s_time
-				if duration < current_app.config['SUB_INTERVAL']:
-					time.sleep(current_app.config['SUB_INTERVAL'] - duration)
+				queue.put_many(unanswered.values())
+
+		in_flight = {}  # future -> (flags, sending time)
+		# Flags older than this have already been marked as EXPIRED: each sweep only looks at the ones after it.
+		# The first sweep covers the whole table.
+		expired_until = 0
+		next_sweep = time.monotonic()
+		while True:
+			for future in [future for future in in_flight if future.done()]:
+				flags, s_time = in_flight.pop(future)
+				handle_result(flags, future, time.monotonic() - s_time)
+
+			remaining = next_sweep - time.monotonic()
+			if remaining <= 0:
+				# Every interval, update status as EXPIRED for flags not sent because too old
+				expiration = expiration_time()
+				queue.prune(expiration)
+				expire_flags(flags_storage, expired_until, expiration, queue.pop_expired())
+				expired_until = expiration
+				stats['rate'] = round(bucket.rate * current_app.config['SUB_INTERVAL'], 2)
+				if standalone:
+					write_loop_stats(app, queue)
+				next_sweep = time.monotonic() + current_app.config['SUB_INTERVAL']
+				continue
+
+			# Send a request as soon as there are flags and a token is available.
+			# The queue is also woken up when a request in flight completes.
+			if len(in_flight) >= submitter.concurrency:
+				queue.wait_for_completion(timeout=remaining)
+				continue
+			if not queue.wait(timeout=remaining, wake_on_empty=bool(in_flight)):
+				continue
+			delay = bucket.wait_time()
+			if delay > 0:
+				time.sleep(min(delay, remaining))
+				continue
+
+			# Send N flags per request
+			flags = queue.get_batch(current_app.config['SUB_PAYLOAD_SIZE'], expiration_time())
+			if not flags:
+				continue
+			bucket.consume()
+			future = submitter.submit_async([item.flag for item in flags])
+			in_flight[future] = (flags, time.monotonic())
+			future.add_done_callback(lambda _: queue.wake())
+
+
+@click.command('submitter')
+@with_appcontext
+def submitter_command():
+	"""Run the submission loop in this process (with SUBMITTER = 'process')."""
+	if current_app.config['SUBMITTER'] != 'process':
+		raise click.ClickException("SUBMITTER is not 'process': the web server runs its own submission loop. "
+								   "Set SUBMITTER = 'process' to run it with this command instead.")
+	loop(current_app._get_current_object(), standalone=True)
+
+
+def init_app(app):
+	if app.config['SUBMITTER'] not in ('thread', 'process'):
+		raise ValueError(f"Invalid SUBMITTER {app.config['SUBMITTER']}. Valid values are ['thread', 'process']")
+	app.extensions['submission_stats'] = Counter()
+	app.cli.add_command(submitter_command)
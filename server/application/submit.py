@@ -1,11 +1,11 @@
 from flask import Blueprint, render_template
+from . import storage
 from .auth import login_required
-from .home import gzipped
 
 bp = Blueprint('submit', __name__)
 
 @bp.route('/submit', methods=['GET'])
 @login_required
-@gzipped
 def submitManually():
-    return render_template('submit.html')
\ No newline at end of file
+    dimensions = storage.get_storage().dimension_values()
+    return render_template('submit.html', exploits_names=dimensions['exploit_name'], team_ips=dimensions['team_ip'])
\ No newline at end of file
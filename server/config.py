@@ -22,11 +22,41 @@ class Config(object):
 
 	FLAGID_URL = 'http://10.10.0.1:8081/flagIds' # flag_ids endpoint, leave blank if none
 
-	SUB_PROTOCOL = 'ccit' # submitter protocol. Valid values are 'dummy', 'ccit', 'faust'
+	SUB_PROTOCOL = 'ccit' # submitter protocol. Valid values are 'dummy', 'ccit', 'ccit_async', 'faust'
 	SUB_LIMIT = 1 # number of requests per interval
 	SUB_INTERVAL = 20 # interval duration
+	SUB_BURST = 1 # number of requests that can be sent back to back after an idle period (at most SUB_LIMIT)
 	SUB_PAYLOAD_SIZE = 500 # max flag per request
+	SUB_PRIORITY = 'newest' # order in which queued flags are sent. Valid values are 'newest', 'edf' (earliest deadline first), 'round_robin' (per exploit and team)
 	SUB_URL = 'http://10.10.0.1:8080/flags'
+	SUB_CONNECTIONS = 1 # parallel connections to the gameserver (faust only)
+	SUBMITTER = 'thread' # 'thread': the web server runs the submission loop, which only sees the flags uploaded to its own process, so the web server needs a single worker. 'process': run it with `flask submitter` (needed with multiple web workers)
+	SUB_POLL_INTERVAL = 0.5 # seconds between checks for new flags in the database (SUBMITTER = 'process' only)
+
+	INGEST_MAX_DELAY = 0.005 # seconds the ingest writer waits to group uploads into a single transaction
+	INGEST_MAX_ROWS = 5000 # max rows per ingest transaction
+	INGEST_TIMEOUT = 30 # seconds an upload waits for its flags to be committed
+	DEDUP_MAX_FLAGS = 200000 # max number of recently uploaded flags remembered (for FLAG_ALIVE seconds) to drop duplicates
+
+	STORAGE = 'sqlite' # 'sqlite': DATABASE. 'memory': no database, flags are lost on exit (single process, SUBMITTER = 'thread'). 'postgres': POSTGRES_DSN (needs psycopg2)
+	POSTGRES_DSN = '' # e.g. 'dbname=flagwarehouse user=flagwarehouse host=localhost'
+
+	ARCHIVE_AFTER_ROUNDS = 10 # rounds after which flags with a final response leave the flags table for flags_archive (0 to keep them all there)
+	ARCHIVE_INTERVAL = 60 # seconds between two archive runs
+	ARCHIVE_BATCH = 5000 # max flags moved per transaction
+
+	CHECKPOINT_INTERVAL = 30 # seconds between two passive WAL checkpoints (0 to leave them to SQLite)
+	WAL_TRUNCATE_SIZE = 64 * 1024 * 1024 # bytes: a larger WAL is truncated once it has been checkpointed
+	OPTIMIZE_INTERVAL = 600 # seconds between two PRAGMA optimize (refreshes the statistics of the query planner)
+	BACKUP_INTERVAL = 0 # seconds between two online backups of the database (0 to disable them)
+	BACKUP_DIR = 'backups' # in the instance folder
+	BACKUP_KEEP = 3 # number of backups kept
+	BACKUP_STEP_PAGES = 256 # pages copied per backup step
+
+	CHART_CACHE_TTL = 2 # seconds a dashboard response is shared between all the clients before being computed again
+	STREAM_INTERVAL = 1 # seconds between two checks for changes pushed to the live dashboards
+	COMPRESS_LEVEL = 6 # gzip level of the responses (1-9)
+	COMPRESS_MIN_SIZE = 500 # bytes, smaller responses are sent uncompressed
 
 	# Don't worry about this
 	DB_NSUB = 'NOT_SUBMITTED'
@@ -36,4 +66,8 @@ class Config(object):
 	DB_EXP = 'EXPIRED'
 
 	DATABASE = 'instance/flagWarehouse.sqlite'
+	DB_POOL_SIZE = 16 # max idle connections kept open, for each of read-only and read-write (STORAGE = 'postgres': max connections)
+	DB_POOL_TIMEOUT = 10 # seconds a request waits for a free connection when they are all taken (STORAGE = 'postgres')
+	DB_CACHED_STATEMENTS = 256 # prepared statements cached by each connection
+	DB_SYNCHRONOUS = 'FULL' # 'FULL': uploads are acknowledged once they are on disk, and survive a power loss. 'NORMAL': one fsync less per commit (faster uploads), but the last commits can be lost on a power loss or an OS crash (not on a crash of the server)
 	#################
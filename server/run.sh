@@ -3,4 +3,5 @@
 export FLASK_DEBUG=True
 export FLASK_APP=application
 flask init-db
+flask compress-static
 flask run --host 0.0.0.0 -p 5555
\ No newline at end of file
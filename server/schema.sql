@@ -1,12 +1,79 @@
+-- Exploits, users and teams (kind is 'exploit_name', 'username' or 'team_ip'), added by the ingest writer
+CREATE TABLE IF NOT EXISTS dimensions
+(
+    id    INTEGER PRIMARY KEY,
+    kind  TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (kind, value)
+);
+
+-- status and server_response are codes, see db.statuses() and db.responses()
 CREATE TABLE IF NOT EXISTS flags
 (
     flag            TEXT PRIMARY KEY,
-    username        TEXT NOT NULL,
-    exploit_name    TEXT NOT NULL,
-    team_ip         TEXT NOT NULL,
-    time            TEXT NOT NULL,
-    status          TEXT DEFAULT 'NOT_SUBMITTED',
-    server_response TEXT
+    user_id         INTEGER NOT NULL REFERENCES dimensions (id),
+    exploit_id      INTEGER NOT NULL REFERENCES dimensions (id),
+    team_id         INTEGER NOT NULL REFERENCES dimensions (id),
+    time            INTEGER NOT NULL, -- Unix time
+    status          INTEGER NOT NULL DEFAULT 0,
+    server_response INTEGER
+);
+
+-- Also used by the explorer, to page through flags by (time, flag)
+CREATE INDEX IF NOT EXISTS idx_time_flag ON flags (time, flag);
+
+-- Flags waiting to be submitted (or expired), by time
+CREATE INDEX IF NOT EXISTS idx_pending ON flags (status, server_response, time);
+
+-- Flags with a final server response, moved out of flags some rounds after they expire (see archive.py)
+CREATE TABLE IF NOT EXISTS flags_archive
+(
+    flag            TEXT PRIMARY KEY,
+    user_id         INTEGER NOT NULL REFERENCES dimensions (id),
+    exploit_id      INTEGER NOT NULL REFERENCES dimensions (id),
+    team_id         INTEGER NOT NULL REFERENCES dimensions (id),
+    time            INTEGER NOT NULL,
+    status          INTEGER NOT NULL,
+    server_response INTEGER NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_time ON flags (time);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_archive_time_flag ON flags_archive (time, flag);
+
+-- Dashboard counters: flags per minute (Unix time / 60), exploit, team, status and response (0 if there is none).
+-- Kept up to date by the triggers below, on ingest and on result write-back. Archived flags are still counted.
+CREATE TABLE IF NOT EXISTS flags_rollup
+(
+    minute     INTEGER NOT NULL,
+    exploit_id INTEGER NOT NULL,
+    team_id    INTEGER NOT NULL,
+    status     INTEGER NOT NULL,
+    response   INTEGER NOT NULL,
+    count      INTEGER NOT NULL,
+    PRIMARY KEY (minute, exploit_id, team_id, status, response)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS flags_rollup_insert AFTER INSERT ON flags
+BEGIN
+    INSERT INTO flags_rollup (minute, exploit_id, team_id, status, response, count)
+    VALUES (NEW.time / 60, NEW.exploit_id, NEW.team_id, NEW.status, IFNULL(NEW.server_response, 0), 1)
+    ON CONFLICT (minute, exploit_id, team_id, status, response) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS flags_rollup_update AFTER UPDATE OF status, server_response ON flags
+    WHEN OLD.status IS NOT NEW.status OR OLD.server_response IS NOT NEW.server_response
+BEGIN
+    UPDATE flags_rollup SET count = count - 1
+    WHERE minute = OLD.time / 60 AND exploit_id = OLD.exploit_id AND team_id = OLD.team_id
+      AND status = OLD.status AND response = IFNULL(OLD.server_response, 0);
+    INSERT INTO flags_rollup (minute, exploit_id, team_id, status, response, count)
+    VALUES (NEW.time / 60, NEW.exploit_id, NEW.team_id, NEW.status, IFNULL(NEW.server_response, 0), 1)
+    ON CONFLICT (minute, exploit_id, team_id, status, response) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS flags_rollup_delete AFTER DELETE ON flags
+    WHEN NOT EXISTS (SELECT 1 FROM flags_archive WHERE flag = OLD.flag)
+BEGIN
+    UPDATE flags_rollup SET count = count - 1
+    WHERE minute = OLD.time / 60 AND exploit_id = OLD.exploit_id AND team_id = OLD.team_id
+      AND status = OLD.status AND response = IFNULL(OLD.server_response, 0);
+END;
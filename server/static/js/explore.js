@@ -1,27 +1,57 @@
 // Table
 let table = $('#table');
-table.bootstrapTable({loadingFontSize: '1rem'});
+let filters = {};
+// Keyset pagination: cursors[n] is the `after` parameter that loads page n, known once page n - 1 is loaded.
+// They are only valid for the same sorting and page size.
+let cursors = {};
+let cursorsKey;
+let requestedPage;
+
+table.bootstrapTable({
+    loadingFontSize: '1rem',
+    sidePagination: 'server',
+    pageSize: 50,
+    pageList: [25, 50, 100, 500],
+    queryParams: function (params) {
+        let key = `${params.sort} ${params.order} ${params.limit}`;
+        if (key !== cursorsKey) {
+            cursors = {};
+            cursorsKey = key;
+        }
+        requestedPage = params.offset / params.limit + 1;
+        let query = Object.assign({}, filters, {limit: params.limit, sort: params.sort, order: params.order});
+        if (requestedPage in cursors)
+            query.after = cursors[requestedPage];
+        else
+            query.offset = params.offset;
+        return query;
+    },
+    responseHandler: function (response) {
+        if (response.next)
+            cursors[requestedPage + 1] = response.next;
+        return response;
+    }
+});
+
+let readFilters = function () {
+    return {
+        exploit_name: $('#exploit_name_select').val().trim(),
+        username: $('#username_select').val().trim(),
+        team_ip: $('#team_ip_select').val().trim(),
+        since: $('#since_datetime').val().replace('T', ' '),
+        until: $('#until_datetime').val().replace('T', ' '),
+        status: $('#status_select').val(),
+        server_response: $('#response_select').val()
+    };
+};
+
 $(function () {
     $(document).on('click', '#refresh', function () {
-        table.bootstrapTable('showLoading');
-        $.ajax({
-            url: '/explore/get_flags',
-            method: 'get',
-            data: {
-                exploit_name: $('#exploit_name_select').val(),
-                username: $('#username_select').val(),
-                team_ip: $('#team_ip_select').val(),
-                since: $('#since_datetime').val().replace('T', ' '),
-                until: $('#until_datetime').val().replace('T', ' '),
-                status: $('#status_select').val(),
-                server_response: $('#response_select').val()
-            },
-            dataType: 'json',
-            success: function (response) {
-                table.bootstrapTable('load', response);
-                table.bootstrapTable('hideLoading');
-            }
-        });
+        filters = readFilters();
+        cursors = {};
+        table.bootstrapTable('refreshOptions', {url: '/explore/get_flags', pageNumber: 1});
+    });
+    $(document).on('click', '.export', function () {
+        window.location = '/explore/export?' + $.param(Object.assign({format: $(this).data('format')}, readFilters()));
     });
 });
-
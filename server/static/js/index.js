@@ -99,6 +99,8 @@ let updateAll = function () {
             exploitFilter: exploitFilter
         },
         dataType: 'json',
+        // No ifModified: the browser revalidates its cached copy of each URL with the ETag of the response
+        // (Cache-Control: no-cache), and hands the cached data back when the server answers 304
         success: function (response) {
             // Doughnut
             chDoughnut.data.datasets[0].data[0] = response.doughnutStatus.accepted;
@@ -211,6 +213,62 @@ let updateAll = function () {
     });
 };
 
+// Live updates (see /index/stream): counters are updated as soon as the server sees them change
+const doughnutIndex = {SUCCESS: 0, NOT_SUBMITTED: 1, EXPIRED: 2, ERROR: 3};
+const barsIndex = {SUCCESS: 0, ERROR: 1};
+
+let addToBars = function (chart, name, status, delta) {
+    if (!(status in barsIndex))
+        return;
+    if (!chart.data.labels.includes(name)) {
+        chart.data.labels.push(name);
+        chart.data.datasets[0].data.push({x: name, y: 0});
+        chart.data.datasets[1].data.push({x: name, y: 0});
+    }
+    chart.data.datasets[barsIndex[status]].data.find(obj => obj.x === name).y += delta;
+};
+
+let applyChanges = function (event) {
+    if (event.queued !== null)
+        $('#queueLength').text(`${event.queued} in queue`);
+    for (const [age, exploit, team, status, delta] of event.changes) {
+        if (mins != 0 && age >= mins)
+            continue;
+        if (status in doughnutIndex)
+            chDoughnut.data.datasets[0].data[doughnutIndex[status]] += delta;
+        addToBars(chBarsExploits, exploit, status, delta);
+        if (!exploitFilter || exploitFilter === exploit) {
+            addToBars(chBarsTeams, team, status, delta);
+            if (!flaggedTeams.includes(team))
+                flaggedTeams.push(team);
+        }
+    }
+    chDoughnut.update();
+    chBarsExploits.update();
+    chBarsTeams.update();
+};
+
+let resetInterval = function () {
+    clearInterval(intervalID);
+    // Also while streaming: the reload moves the time window forward, and fixes the counters of the minutes
+    // the stream doesn't follow (see stream.py), as well as the changes counted both by a reload and a message
+    intervalID = setInterval(updateAll, secs * 1000);
+};
+
+let startStream = function () {
+    if (!window.EventSource)
+        return;
+    let source = new EventSource('/index/stream');
+    // EventSource reconnects by itself, the charts keep being reloaded in the meantime
+    source.onopen = function () {
+        updateAll();
+        resetInterval();
+    };
+    source.onmessage = function (message) {
+        applyChanges(JSON.parse(message.data));
+    };
+};
+
 let showTeamsInfo = function() {
     let missingTeams = [];
     let exploitableTeams = numberOfTeams - 1;
@@ -243,8 +301,10 @@ window.onload = function () {
     mins = $('#minsSelect').val();
     secs = $('#autorefreshSelect').val();
     exploitFilter = '';
+    flaggedTeams = [];
     updateAll();
-    intervalID = setInterval(updateAll, secs * 1000);
+    resetInterval();
+    startStream();
 };
 
 $('#minsSelect').on('change', function () {
@@ -255,8 +315,7 @@ $('#minsSelect').on('change', function () {
 $('#autorefreshSelect').on('change', function () {
     secs = $('#autorefreshSelect').val();
     updateAll();
-    clearInterval(intervalID);
-    intervalID = setInterval(updateAll, secs * 1000);
+    resetInterval();
 })
 
 $('#exploitSelect').on('change', function () {
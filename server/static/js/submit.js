@@ -7,12 +7,15 @@ $("#submit").on("click", function() {
     var tzoffset = (new Date()).getTimezoneOffset() * 60000; // timezone offset in milliseconds
     var time = (new Date(Date.now() - tzoffset)).toISOString().slice(0, -5).replace('T', ' ');
 
+    var exploit_name = $('#exploit_name').val().trim() || "<manual>";
+    var team_ip = $('#team_ip').val().trim() || nopTeam;
+
     // flags format: (flag, exploit_name, team_ip, time)
     var data = {"username": "WebAdmin", "flags": []};
     $.each($('#flags').val().split(/\n/), function(i, flag){
         flag = flag.trim();
         if(flag)
-            data.flags.push({"flag": flag, "exploit_name": "<manual>", "team_ip": "10.60.0.1", "time": time});
+            data.flags.push({"flag": flag, "exploit_name": exploit_name, "team_ip": team_ip, "time": time});
     });
 
     if(data.flags.length > 0) {
@@ -25,7 +28,7 @@ $("#submit").on("click", function() {
                 $("#result")
                     .removeClass("alert-error")
                     .addClass("alert-info")
-                    .text(response)
+                    .text(`${response.new} new flags, ${response.duplicate} duplicates`)
                     .show(250);
             },
             error: function(xhr, status, error){
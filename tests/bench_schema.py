@@ -0,0 +1,135 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../server'))
+
+from flask import Flask
+
+from application import db, home, storage
+from fill_db import random_flags
+
+# Size of the database and time of the dashboard queries before and after migration 5 (compact flags):
+#   python3 bench_schema.py --rows 1000000
+
+# The flags table of the first schema.sql: migrations 1 to 4 bring it to the layout before migration 5
+TEXT_FLAGS = '''
+CREATE TABLE flags
+(
+    flag            TEXT PRIMARY KEY,
+    username        TEXT NOT NULL,
+    exploit_name    TEXT NOT NULL,
+    team_ip         TEXT NOT NULL,
+    time            TEXT NOT NULL,
+    status          TEXT DEFAULT 'NOT_SUBMITTED',
+    server_response TEXT
+);
+CREATE INDEX idx_time ON flags (time);
+'''
+
+# The dashboard queries of the text layout (home.compute_chart_data before migration 5)
+TEXT_CHART_QUERIES = [
+    '''
+    WITH counts (minute, exploit_name, team_ip, status, count) AS (
+        SELECT minute, exploit_name, team_ip, status, count FROM flags_rollup WHERE minute > :minute AND count > 0
+        UNION ALL
+        SELECT substr(time, 1, 16), exploit_name, team_ip, COALESCE(server_response, status), 1
+        FROM flags WHERE time >= :time AND time < :next_minute
+    )
+    ''' + query for query in (
+        '''
+        SELECT SUM(count * (status = :succ)), SUM(count * (status = :err)),
+               SUM(count * (status = :nsub AND minute >= :expiration)),
+               SUM(count * (status = :exp OR status = :nsub AND minute < :expiration))
+        FROM counts
+        ''',
+        'SELECT exploit_name, SUM(count * (status = :succ)), SUM(count * (status = :err)) '
+        'FROM counts GROUP BY exploit_name ORDER BY MIN(minute)',
+        'SELECT team_ip, SUM(count * (status = :succ)), SUM(count * (status = :err)) '
+        'FROM counts GROUP BY team_ip ORDER BY team_ip',
+    )
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Flags table layout benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help='number of flags')
+    parser.add_argument('--hours', type=float, default=8, help='the flags are spread over the last HOURS')
+    parser.add_argument('--mins', type=int, default=5, help='time range of the dashboard (0 is everything)')
+    parser.add_argument('--repeat', type=int, default=20, help='dashboard loads to average')
+    return parser.parse_args()
+
+
+def size(path):
+    con = sqlite3.connect(path)
+    con.execute('VACUUM')
+    con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    con.close()
+    return os.path.getsize(path) / 2 ** 20
+
+
+def timed(repeat, function):
+    s_time = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - s_time) / repeat * 1000
+
+
+def text_chart_data(con, app, mins):
+    now = datetime.now()
+    start = (now - timedelta(minutes=mins)).replace(microsecond=0).isoformat(sep=' ') if mins else ''
+    params = {
+        'minute': start[:16],
+        'time': start,
+        'next_minute': (datetime.fromisoformat(start).replace(second=0) + timedelta(minutes=1)).isoformat(sep=' ')
+        if mins else '',
+        'expiration': (now - timedelta(seconds=app.config['FLAG_ALIVE'])).isoformat(sep=' ')[:16],
+        'succ': app.config['DB_SUCC'], 'err': app.config['DB_ERR'],
+        'exp': app.config['DB_EXP'], 'nsub': app.config['DB_NSUB'],
+    }
+    for query in TEXT_CHART_QUERIES:
+        con.execute(query, params).fetchall()
+
+
+def main(args):
+    app = Flask('bench')
+    app.config.from_object('config.Config')
+    directory = tempfile.mkdtemp()
+    before, after = os.path.join(directory, 'before.sqlite'), os.path.join(directory, 'after.sqlite')
+    app.config['DATABASE'] = after
+    db.init_app(app)
+    storage.init_app(app)
+
+    con = sqlite3.connect(before)
+    con.executescript(TEXT_FLAGS)
+    with con:
+        con.executemany('INSERT INTO flags VALUES (?, ?, ?, ?, ?, ?, ?)', random_flags(args.rows, args.hours))
+    for script in db.MIGRATIONS[:4]:
+        con.executescript(script)
+    con.execute('PRAGMA user_version = 4')
+    con.close()
+    print(f'before: {size(before):.1f} MiB', end=', ')
+    con = sqlite3.connect(before)
+    print(f'chart_data {timed(args.repeat, lambda: text_chart_data(con, app, args.mins)):.1f} ms')
+    con.close()
+
+    shutil.copy(before, after)
+    with app.app_context():
+        s_time = time.time()
+        db.migrate(db.get_db())
+        print(f'migration: {time.time() - s_time:.1f} s')
+    print(f'after: {size(after):.1f} MiB', end=', ')
+    with app.app_context():
+        print(f'chart_data {timed(args.repeat, lambda: home.compute_chart_data(args.mins, "")):.1f} ms')
+
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../server'))
+
+from flask import Flask
+
+from application.submission_loop import CCITAsyncSubmitter, CCITSubmitter
+
+# Compares the ccit and ccit_async submitters against verification_server.py:
+#   python3 verification_server.py 0.2 &
+#   python3 bench_submitter.py --limit 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Submitter throughput benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000/flags', help='gameserver URL')
+    parser.add_argument('--limit', type=int, default=10, help='SUB_LIMIT (requests in flight for ccit_async)')
+    parser.add_argument('--payload', type=int, default=100, help='flags per request')
+    parser.add_argument('--requests', type=int, default=50, help='requests sent by each submitter')
+    return parser.parse_args()
+
+
+def run(submitter, batches):
+    s_time = time.time()
+    in_flight = []
+    answered = 0
+    for batch in batches:
+        in_flight.append(submitter.submit_async(batch))
+        if len(in_flight) >= submitter.concurrency:
+            answered += len(in_flight.pop(0).result())
+    for future in in_flight:
+        answered += len(future.result())
+    return answered / (time.time() - s_time)
+
+
+def main(args):
+    app = Flask('bench')
+    app.config.update(SUB_URL=args.url, TEAM_TOKEN='', SUB_LIMIT=args.limit, SUB_INTERVAL=60)
+    batches = [[f'BENCH{i:06d}{j:04d}=' for j in range(args.payload)] for i in range(args.requests)]
+
+    with app.app_context():
+        for name, submitter_class in (('ccit', CCITSubmitter), ('ccit_async', CCITAsyncSubmitter)):
+            submitter = submitter_class()
+            print(f'{name}: {run(submitter, batches):.0f} flags/s')
+            submitter.close()
+
+
+if __name__ == '__main__':
+    main(parse_args())
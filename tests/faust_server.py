@@ -0,0 +1,54 @@
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+from queue import Queue
+
+# Stand-in for a ctf-gameserver submission service (https://ctf-gameserver.org/submission/).
+# Usage: python3 faust_server.py [latency in seconds]
+# then set SUB_PROTOCOL = 'faust' and SUB_URL = 'tcp://localhost:6666/' in the server config.
+# Every response is delayed by the given latency, like on a remote link, without blocking the
+# flags that come after it: pipelined submitters are much faster against it than sequential ones.
+
+PORT = 6666
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+
+class ServerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wfile.write(b'Fake ctf-gameserver submission service\nOne flag per line please!\n\n')
+        responses = Queue()
+        writer = threading.Thread(target=self.write_responses, args=(responses,), daemon=True)
+        writer.start()
+        for line in self.rfile:
+            flag = line.strip().decode(errors='replace')
+            if not flag:
+                continue
+            code = random.choices(population=['OK', 'DUP', 'OLD', 'INV'], weights=(1, 0.1, 0.1, 0.1), k=1)[0]
+            responses.put((time.monotonic() + LATENCY, f'{flag} {code}\n'.encode()))
+        responses.put(None)
+        writer.join()
+
+    def write_responses(self, responses):
+        while True:
+            item = responses.get()
+            if item is None:
+                return
+            due, response = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(response)
+            except OSError:
+                return
+
+
+socketserver.ThreadingTCPServer.allow_reuse_address = True
+httpd = socketserver.ThreadingTCPServer(("", PORT), ServerHandler)
+
+print("Serving at port", PORT, "with latency", LATENCY)
+httpd.serve_forever()
@@ -1,3 +1,4 @@
+import argparse
 import datetime
 import random
 import sqlite3
@@ -6,6 +7,10 @@ usernames = ['ecavicc', 'pippo', 'pluto', 'paperino']
 exploits = ['sploit1.py', '1337haxx.py', 'exp1.py', 'pwn.py', 'myexploit.py']
 ips = ['10.0.{}.1'.format(i) for i in range(1, 25)]
 
+# Codes of the status and server_response columns with the default DB_* settings (see db.statuses() and db.responses())
+statuses = ['NOT_SUBMITTED', 'SUBMITTED']
+responses = [None, 'ERROR', 'EXPIRED', 'SUCCESS']
+
 
 def rand_time(start: datetime = datetime.datetime.now(), hrs: float = 1) -> datetime:
     stime_ms = (start - datetime.timedelta(hours=hrs)).timestamp()
@@ -14,20 +19,42 @@ def rand_time(start: datetime = datetime.datetime.now(), hrs: float = 1) -> date
     return datetime.datetime.fromtimestamp(rtime_ms)
 
 
-if __name__ == '__main__':
-    rows = []
-    for i in range(10000):
+def random_flags(count: int, hrs: float):
+    """(flag, username, exploit_name, team_ip, time, status, server_response), with the names of the old layout."""
+    for i in range(count):
         status = random.choices(population=['SUBMITTED', 'NOT_SUBMITTED'], weights=(0.1, 1), k=1)[0]
         response = None
         if status == 'SUBMITTED':
             response = random.choice(['SUCCESS', 'ERROR', 'EXPIRED'])
-        rows.append(('FLG{{{}}}'.format(str(i).zfill(10)), random.choice(usernames), random.choice(exploits),
-                     random.choice(ips), rand_time(hrs=0.001).replace(microsecond=0).isoformat(sep=' '), status, response))
-
-    with sqlite3.connect('../instance/flagWarehouse.sqlite') as con:
-        with con as cur:
-            # noinspection SqlWithoutWhere
-            cur.execute('DELETE FROM flags')
-            cur.executemany(
-                'INSERT OR IGNORE INTO flags (flag, username, exploit_name, team_ip, time, status, server_response) '
-                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        yield ('FLG{{{}}}'.format(str(i).zfill(10)), random.choice(usernames), random.choice(exploits),
+               random.choice(ips), rand_time(hrs=hrs).replace(microsecond=0).isoformat(sep=' '), status, response)
+
+
+def fill(con: sqlite3.Connection, flags):
+    """Replace the flags of a database with the current schema."""
+    with con as cur:
+        # noinspection SqlWithoutWhere
+        cur.execute('DELETE FROM flags')
+        for kind, values in (('username', usernames), ('exploit_name', exploits), ('team_ip', ips)):
+            cur.executemany('INSERT OR IGNORE INTO dimensions (kind, value) VALUES (?, ?)',
+                            [(kind, value) for value in values])
+        ids = {(kind, value): id_ for id_, kind, value in cur.execute('SELECT id, kind, value FROM dimensions')}
+        cur.executemany(
+            'INSERT OR IGNORE INTO flags (flag, user_id, exploit_id, team_id, time, status, server_response) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((flag, ids['username', username], ids['exploit_name', exploit_name], ids['team_ip', team_ip],
+              int(datetime.datetime.fromisoformat(time).timestamp()), statuses.index(status),
+              responses.index(response) or None)
+             for flag, username, exploit_name, team_ip, time, status, response in flags))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the database with random flags',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--db', default='../instance/flagWarehouse.sqlite', help='database file')
+    parser.add_argument('--rows', type=int, default=10000, help='number of flags')
+    parser.add_argument('--hours', type=float, default=0.001, help='the flags are spread over the last HOURS')
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as con:
+        fill(con, random_flags(args.rows, args.hours))
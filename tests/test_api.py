@@ -0,0 +1,85 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+SERVER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../server')
+sys.path.insert(1, SERVER)
+
+from application import create_app, storage
+
+# Uploads through the API, on a throwaway database:
+#   python3 -m unittest test_api
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        # The application finds schema.sql and its templates in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(SERVER)
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'DATABASE': os.path.join(self.directory, 'flagWarehouse.sqlite'),
+            'SUBMITTER': 'process',  # nothing gets submitted
+        })
+        with self.app.app_context():
+            storage.get_storage().init()
+        self.client = self.app.test_client()
+        self.headers = {'X-Auth-Token': self.app.config['API_TOKEN']}
+        self.now = datetime.now().replace(microsecond=0).isoformat(sep=' ')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.chdir(self.cwd)
+
+    def flag(self, i, **fields):
+        return {'flag': f'{i:031d}=', 'exploit_name': 'sploit.py', 'team_ip': '10.0.0.1', 'time': self.now, **fields}
+
+    def upload(self, body):
+        return self.client.post('/api/upload_flags', json=body, headers=self.headers)
+
+    def test_upload(self):
+        r = self.upload({'username': 'user', 'flags': [self.flag(0), self.flag(1)]})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json(), {'new': 2, 'duplicate': 0})
+        r = self.upload({'username': 'user', 'flags': [self.flag(1), self.flag(2)]})
+        self.assertEqual(r.get_json(), {'new': 1, 'duplicate': 1})
+
+    def test_malformed_body(self):
+        for body in ([self.flag(0)], {'username': 'user'}, {'username': 'user', 'flags': 'x'},
+                     {'username': 'user', 'flags': ['x']}, {'username': 'user', 'flags': [self.flag(0), None]}):
+            with self.subTest(body=body):
+                self.assertEqual(self.upload(body).status_code, 400)
+        r = self.client.post('/api/upload_flags', data='not json', headers=self.headers)
+        self.assertEqual(r.status_code, 400)
+
+    def test_malformed_flags(self):
+        for flag in (self.flag(0, flag=None), self.flag(0, flag=5), self.flag(0, exploit_name=None),
+                     self.flag(0, team_ip=['10.0.0.1']), self.flag(0, time='yesterday')):
+            with self.subTest(flag=flag):
+                self.assertEqual(self.upload({'username': 'user', 'flags': [flag]}).status_code, 400)
+        self.assertEqual(self.upload({'flags': [self.flag(0)]}).status_code, 400)
+        # The ingest writer is still there
+        self.assertEqual(self.upload({'username': 'user', 'flags': [self.flag(0)]}).status_code, 200)
+
+    def test_upload_stream(self):
+        records = [self.flag(0), self.flag(1), self.flag(0)]
+        r = self.client.post('/api/upload_flags_stream?username=user',
+                             data=gzip.compress(''.join(json.dumps(record) + '\n' for record in records).encode()),
+                             headers={**self.headers, 'Content-Type': 'application/x-ndjson',
+                                      'Content-Encoding': 'gzip'})
+        self.assertEqual(r.get_json(), {'new': 2, 'duplicate': 1})
+        for body in ('[1, 2]\n', '{"flag": \n', json.dumps(self.flag(2, team_ip=None)) + '\n'):
+            with self.subTest(body=body):
+                r = self.client.post('/api/upload_flags_stream?username=user', data=body,
+                                     headers={**self.headers, 'Content-Type': 'application/x-ndjson'})
+                self.assertEqual(r.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
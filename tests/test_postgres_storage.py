@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../server'))
+
+from flask import Flask
+
+from application import storage
+
+# Runs the PostgreSQL engine against a real server, for example:
+#   POSTGRES_TEST_DSN='dbname=flagwarehouse_test' python3 -m unittest test_postgres_storage
+# The flags and dimensions tables of that database are DROPPED: use a scratch database.
+DSN = os.environ.get('POSTGRES_TEST_DSN')
+
+
+@unittest.skipUnless(DSN, 'POSTGRES_TEST_DSN is not set')
+class PostgresStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask('test')
+        self.app.config.from_object('config.Config')
+        # A small pool, so that there are more users than connections
+        self.app.config.update(STORAGE='postgres', POSTGRES_DSN=DSN, SUBMITTER='thread', DB_POOL_SIZE=2)
+        storage.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.flags = storage.get_storage()
+        with self.flags._connection() as connection, connection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS flags, dimensions')
+        self.flags.init()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        if self.flags._pool is not None:
+            self.flags._pool.closeall()
+        self.context.pop()
+
+    def row(self, i, exploit_name='sploit.py', team_ip='10.0.0.1', age=0):
+        return f'FLAG{i:04d}=', 'user', exploit_name, team_ip, self.now - age, self.app.config['DB_NSUB']
+
+    def test_insert_skips_duplicates(self):
+        first, second = self.flags.insert_batch([[self.row(0), self.row(1)], [self.row(1), self.row(2)]])
+        self.assertEqual([row[0] for row in first], ['FLAG0000=', 'FLAG0001='])
+        self.assertEqual([row[0] for row in second], ['FLAG0002='])
+        self.assertEqual(self.flags.insert_batch([[self.row(0)]]), [[]])
+        self.assertEqual(self.flags.count({}), (3, False))
+
+    def test_missing_dimension(self):
+        with self.assertRaises((ValueError, *self.flags.ERRORS)):
+            self.flags.insert_batch([[self.row(0, exploit_name=None)]])
+        self.assertEqual(self.flags.count({}), (0, False))
+
+    def test_submission(self):
+        position, rows = self.flags.new_flags(None)
+        self.assertEqual(rows, [])
+        self.flags.insert_batch([[self.row(0, age=2), self.row(1, age=1), self.row(2, age=1000)]])
+        position, rows = self.flags.new_flags(position)
+        self.assertEqual([row[0] for row in rows], ['FLAG0000=', 'FLAG0001=', 'FLAG0002='])
+        self.assertEqual(self.flags.new_flags(position), (position, []))
+
+        self.assertEqual([row[0] for row in self.flags.submittable(self.now - 100)], ['FLAG0000=', 'FLAG0001='])
+        self.flags.write_results([('FLAG0000=', self.app.config['DB_SUCC'])])
+        self.flags.expire(0, self.now - 100)
+        self.assertEqual([row[0] for row in self.flags.submittable(0)], ['FLAG0001='])
+
+        responses = {row[0]: row[6] for row in self.flags.export({})}
+        self.assertEqual(responses, {'FLAG0000=': self.app.config['DB_SUCC'], 'FLAG0001=': None,
+                                     'FLAG0002=': self.app.config['DB_EXP']})
+
+    def test_chart_data(self):
+        self.flags.insert_batch([[self.row(0), self.row(1, exploit_name='other.py', team_ip='10.0.0.2'),
+                                  self.row(2, age=1000)]])
+        self.flags.write_results([('FLAG0000=', self.app.config['DB_SUCC'])])
+        data = self.flags.chart_data(None, self.now - 500, '')
+        self.assertEqual(data['doughnutStatus'], {'accepted': 1, 'error': 0, 'queued': 1, 'expired': 1})
+        self.assertEqual(sorted(bar['name'] for bar in data['barsExploit']), ['other.py', 'sploit.py'])
+        data = self.flags.chart_data(self.now - 500, self.now - 500, 'other.py')
+        self.assertEqual(data['barsTeams'], [{'name': '10.0.0.2', 'accepted': 0, 'error': 0}])
+
+    def test_explore(self):
+        self.flags.insert_batch([[self.row(i, team_ip=f'10.0.0.{i % 3}', age=i) for i in range(10)]])
+        page = self.flags.explore({'team_ip': '10.0.0.1'}, 'time', True, 2, 0, None)
+        self.assertEqual([row[0] for row in page], ['FLAG0001=', 'FLAG0004='])
+        page = self.flags.explore({'team_ip': '10.0.0.1'}, 'time', True, 2, 0, (page[-1][7], page[-1][0]))
+        self.assertEqual([row[0] for row in page], ['FLAG0007='])
+        self.assertEqual(self.flags.count({'status': 'nonsense'}), (0, False))
+
+    def test_more_users_than_connections(self):
+        self.flags.insert_batch([[self.row(i, age=i % 100) for i in range(2500)]])
+        # A streamed export doesn't keep a connection between its chunks
+        export = self.flags.export({})
+        first = next(export)
+        errors = []
+
+        def load():
+            with self.app.app_context():
+                try:
+                    for _ in range(5):
+                        self.flags.dimension_values()
+                        self.flags.count({'team_ip': '10.0.0.1'})
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=load) for _ in range(4 * self.app.config['DB_POOL_SIZE'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len([first, *export]), 2500)
+
+    def test_one_pool(self):
+        self.flags._pool.closeall()
+        self.flags._pool = None
+
+        def load():
+            with self.app.app_context():
+                self.flags.dimension_values()
+        threads = [threading.Thread(target=load) for _ in range(8)]
+        pools = set()
+        original = storage.postgres.psycopg2.pool.ThreadedConnectionPool
+
+        def pool(*args):
+            created = original(*args)
+            pools.add(created)
+            return created
+        storage.postgres.psycopg2.pool.ThreadedConnectionPool = pool
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            storage.postgres.psycopg2.pool.ThreadedConnectionPool = original
+        self.assertEqual(len(pools), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
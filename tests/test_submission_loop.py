@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+
+SERVER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../server')
+sys.path.insert(1, SERVER)
+
+from application import create_app, storage, submission_loop
+
+# The submission loop run by the web server (SUBMITTER = 'thread'), with the dummy submitter:
+#   python3 -m unittest test_submission_loop
+# It takes a few seconds: the loop waits a bit before starting.
+
+
+class ThreadSubmitterTest(unittest.TestCase):
+
+    def setUp(self):
+        # The application finds schema.sql and its templates in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(SERVER)
+        self.directory = tempfile.mkdtemp()
+        self.loops = self.running_loops()
+        self.app = create_app({
+            'DATABASE': os.path.join(self.directory, 'flagWarehouse.sqlite'),
+            'SUBMITTER': 'thread',
+            'SUB_PROTOCOL': 'dummy',
+            'SUB_INTERVAL': 1,
+            'SUB_LIMIT': 10,
+        })
+        with self.app.app_context():
+            storage.get_storage().init()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.chdir(self.cwd)
+
+    @staticmethod
+    def running_loops():
+        return sum(thread.name == 'submission_loop' for thread in threading.enumerate())
+
+    def test_uploads_reach_the_loop(self):
+        # Not started by create_app() (e.g. for CLI commands), only by the process that serves the uploads
+        self.assertEqual(self.running_loops(), self.loops)
+        now = datetime.now().replace(microsecond=0).isoformat(sep=' ')
+        flags = [{'flag': f'{i:031d}=', 'exploit_name': 'sploit.py', 'team_ip': '10.0.0.1', 'time': now}
+                 for i in range(20)]
+        r = self.client.post('/api/upload_flags', json={'username': 'user', 'flags': flags},
+                             headers={'X-Auth-Token': self.app.config['API_TOKEN']})
+        self.assertEqual(r.get_json(), {'new': 20, 'duplicate': 0})
+        self.assertEqual(self.running_loops(), self.loops + 1)
+
+        submitted = []
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and len(submitted) < 20:
+            time.sleep(0.5)
+            with self.app.app_context():
+                submitted = [row for row in storage.get_storage().explore({}, 'time', False, None, 0, None)
+                             if row[5] == self.app.config['DB_SUB']]
+        self.assertEqual(len(submitted), 20)
+        with self.app.app_context():
+            self.assertEqual(submission_loop.loop_stats()['queue']['sent'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
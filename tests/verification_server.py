@@ -1,27 +1,46 @@
 import http.server
+import json
 import random
 import socketserver
+import sys
+import time
+
+# Stand-in for a CCIT-style gameserver: PUT a JSON list of flags, get back a JSON list of {"flag", "msg"}.
+# Usage: python3 verification_server.py [latency in seconds]
 
 PORT = 8000
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0
 
 
 class ServerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
     def do_PUT(self):
-        body = random.choices(
-            population=['accepted\n', 'invalid\n', 'too old', 'is not available'],
-            weights=(1, 0.1),
-            k=1
-        )[0]
+        flags = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(LATENCY)
+        body = json.dumps([{
+            'flag': flag,
+            'msg': random.choices(
+                population=['accepted', 'invalid', 'too old', 'is not available'],
+                weights=(1, 0.1, 0.1, 0.1),
+                k=1
+            )[0]
+        } for flag in flags]).encode()
         self.send_response(200)
-        self.send_header("Content-type", "text/html; charset=utf-8")
+        self.send_header("Content-type", "application/json")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(bytes(body, 'utf-8'))
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 handler = ServerHandler
 
-httpd = socketserver.TCPServer(("", PORT), handler)
+socketserver.ThreadingTCPServer.allow_reuse_address = True
+socketserver.ThreadingTCPServer.daemon_threads = True
+httpd = socketserver.ThreadingTCPServer(("", PORT), handler)
 
 print("Serving at port", PORT)
 httpd.serve_forever()